@@ -0,0 +1,84 @@
+"""
+Benchmark the import time of the entry points of the training
+and of the generation (e.g., of a compression worker).
+
+Each module is imported in a fresh interpreter, and the heavy optional
+dependencies (which should be imported only at the point of use),
+that were loaded by the import, are reported.
+
+Usage:
+    python benchmarks/startup.py
+    python benchmarks/startup.py --modules generate.utils --max-seconds 1
+
+The script exits with an error, if any import took longer than
+the given time limit.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from tabulate import tabulate
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["gensim", "nltk", "sklearn", "matplotlib", "seaborn",
+                 "umap", "visdom", "pymongo", "graphviz", "pandas", "rouge",
+                 "sentencepiece"]
+
+_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{"seconds": elapsed, "heavy": heavy}}))
+"""
+
+
+def import_time(module, repeats=3):
+    """
+    Import the given module in a fresh interpreter and
+    return the (best) import time and the loaded heavy modules.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([BASE_DIR,
+                                         env.get("PYTHONPATH", "")])
+    script = _SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+
+    results = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, "-c", script], cwd=BASE_DIR,
+                             env=env, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        if out.returncode != 0:
+            return {"error": out.stderr.decode().strip().splitlines()[-1]}
+        results.append(json.loads(out.stdout.decode().splitlines()[-1]))
+
+    return min(results, key=lambda x: x["seconds"])
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--modules", nargs="+",
+                    default=["torch", "generate.utils", "modules.models",
+                             "models.seq3_trainer", "mylogger.experiment"])
+parser.add_argument("--repeats", type=int, default=3)
+parser.add_argument("--max-seconds", type=float, default=1.0,
+                    help="the maximum allowed import time of each module")
+args = parser.parse_args()
+
+results = {m: import_time(m, args.repeats) for m in args.modules}
+
+print(tabulate([[m, r.get("seconds"), ", ".join(r.get("heavy", [])),
+                 r.get("error", "")]
+                for m, r in results.items()],
+               headers=["module", "import (sec)", "heavy dependencies",
+                        "error"],
+               floatfmt=".3f"))
+
+failed = [m for m, r in results.items()
+          if "error" in r or r["seconds"] > args.max_seconds]
+if len(failed) > 0:
+    sys.exit(f"Imports that failed or were slower than {args.max_seconds}s: "
+             f"{', '.join(failed)}")
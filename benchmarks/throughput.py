@@ -0,0 +1,83 @@
+"""
+Benchmark the throughput of the training steps, of the inference
+and of the data pipeline, on synthetic data, across different
+batch sizes, sequence lengths and vocabulary sizes.
+
+Each case runs in its own process, in order to measure its peak RSS.
+
+Usage:
+    python benchmarks/throughput.py --out results.json
+    python benchmarks/throughput.py --baseline results.json --tolerance 0.1
+
+When a baseline is given, the script exits with an error
+if any metric regressed by more than the given tolerance.
+"""
+import argparse
+import datetime
+import itertools
+import platform
+import sys
+
+import torch
+from tabulate import tabulate
+
+from benchmarks.utils import BENCHMARKS, case_name, compare, read_results, \
+    run_isolated, write_results
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--benchmarks", nargs="+", default=list(BENCHMARKS),
+                    choices=list(BENCHMARKS))
+parser.add_argument("--batch-sizes", nargs="+", type=int, default=[20, 64])
+parser.add_argument("--seq-lens", nargs="+", type=int, default=[50])
+parser.add_argument("--vocab-sizes", nargs="+", type=int,
+                    default=[10000, 15000])
+parser.add_argument("--steps", type=int, default=20,
+                    help="number of (measured) steps per case")
+parser.add_argument("--device", default="cuda" if torch.cuda.is_available()
+                    else "cpu")
+parser.add_argument("--out", help="the json file to write the results to")
+parser.add_argument("--baseline", help="a json file with baseline results")
+parser.add_argument("--tolerance", type=float, default=0.1,
+                    help="the relative change, that counts as regression")
+args = parser.parse_args()
+
+results = {}
+for name, bs, sl, vs in itertools.product(args.benchmarks, args.batch_sizes,
+                                          args.seq_lens, args.vocab_sizes):
+    case = case_name(name, bs, sl, vs)
+    print(f"Running {case}...")
+    results[case] = run_isolated(name, batch_size=bs, seq_len=sl,
+                                 vocab_size=vs, steps=args.steps,
+                                 device=args.device)
+    if "error" in results[case]:
+        print(results[case]["error"])
+
+print(tabulate([[case, r.get("step_ms"), r.get("tokens_per_sec"),
+                 r.get("samples_per_sec"), r.get("peak_rss_mb")]
+                for case, r in results.items()],
+               headers=["case", "step (ms)", "tokens/sec", "samples/sec",
+                        "peak RSS (MB)"],
+               floatfmt=".2f"))
+
+if args.out:
+    meta = {
+        "date": datetime.datetime.now().isoformat(),
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "device": args.device,
+        "steps": args.steps,
+    }
+    write_results(args.out, results, meta)
+
+if args.baseline:
+    table, regressions = compare(results, read_results(args.baseline),
+                                 args.tolerance)
+    print()
+    print(table)
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.tolerance:.0%}!")
+        sys.exit(1)
+
+if any("error" in r for r in results.values()):
+    sys.exit(1)
@@ -0,0 +1,326 @@
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+import traceback
+
+import numpy
+import torch
+from tabulate import tabulate
+from torch import nn
+
+from models.seq3_trainer import Seq3Trainer
+from models.sent_lm_trainer import LMTrainer
+from modules.data.collates import Seq2SeqCollate, LMCollate
+from modules.data.datasets import AEDataset, SentenceLMDataset
+from modules.models import Seq2Seq2Seq
+from modules.modules import SeqReader
+from sys_config import MODEL_CNF_DIR
+from utils.config import load_config
+from utils.transfer import freeze_module
+
+
+def synthetic_corpus(n_samples, seq_len, vocab_size, seed=0):
+    """
+    Generate a corpus of sentences with Zipfian word frequencies.
+    The number of word types is larger than `vocab_size`,
+    so that the vocabulary has to be trimmed and some words are OOVs.
+    """
+    rng = numpy.random.RandomState(seed)
+    n_types = int(vocab_size * 1.2)
+    probs = 1 / numpy.arange(1, n_types + 1)
+    probs /= probs.sum()
+
+    lengths = rng.randint(max(seq_len // 2, 1), seq_len + 1, n_samples)
+    words = rng.choice(n_types, lengths.sum(), p=probs)
+    words = numpy.split(words, numpy.cumsum(lengths)[:-1])
+
+    return [" ".join(f"w{i}" for i in s) for s in words]
+
+
+def load_model_config(name, batch_size, seq_len):
+    config = load_config(os.path.join(MODEL_CNF_DIR, name))
+    config["batch_size"] = batch_size
+    config["data"]["seq_len"] = seq_len
+    return config
+
+
+class PreloadedLoader:
+    """
+    A loader, which yields a fixed list of (collated) batches, in order to
+    exclude the data pipeline from the timings of the model.
+    """
+
+    def __init__(self, dataset, batches):
+        self.dataset = dataset
+        self.batches = batches
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def preload(dataset, collate, batch_size, n_batches):
+    indices = range(min(len(dataset), batch_size * n_batches))
+    samples = [dataset[i] for i in indices]
+    return PreloadedLoader(dataset, [collate(samples[i:i + batch_size])
+                                     for i in range(0, len(samples),
+                                                    batch_size)])
+
+
+def _sync(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+def _timed_epoch(trainer, field, device):
+    """
+    Run one epoch and return the duration and the number of tokens
+    (the sum of the lengths in the `field` of each batch) of each step.
+    """
+    times, tokens = [], []
+
+    def timer(batch, *args):
+        _sync(device)
+        now = time.perf_counter()
+        times.append(now - timer.last)
+        timer.last = now
+        tokens.append(int(batch[field].sum()))
+
+    timer.last = time.perf_counter()
+    trainer.batch_end_callbacks = [timer]
+    trainer.train_epoch()
+
+    return times, tokens
+
+
+def _summary(times, tokens, samples):
+    return {
+        "step_ms": statistics.median(times) * 1000,
+        "step_p90_ms": float(numpy.percentile(times, 90)) * 1000,
+        "tokens_per_sec": sum(tokens) / sum(times),
+        "samples_per_sec": samples / sum(times),
+    }
+
+
+def bench_seq3_train(batch_size, seq_len, vocab_size, steps, device):
+    """
+    Training steps (forward, backward and update) of Seq2Seq2Seq,
+    with all the losses of model_configs/seq3.yaml.
+    """
+    config = load_model_config("seq3.yaml", batch_size, seq_len)
+    lm_config = load_model_config("lm.yaml", batch_size, seq_len)
+
+    corpus = synthetic_corpus(batch_size * (steps + 1), seq_len, vocab_size)
+    data = AEDataset(corpus, preprocess=str.split, vocab_size=vocab_size,
+                     seq_len=seq_len, oovs=config["data"]["oovs"],
+                     verbose=False)
+    n_tokens = len(data.vocab)
+
+    model = Seq2Seq2Seq(n_tokens, **config["model"])
+    model.to(device)
+
+    oracle = SeqReader(n_tokens, **lm_config["model"])
+    oracle.to(device)
+    freeze_module(oracle)
+
+    loss_weights = [config["model"]["loss_weight_reconstruction"]]
+    if config["model"]["prior_loss"]:
+        loss_weights.append(config["model"]["loss_weight_prior"])
+    if config["model"]["topic_loss"]:
+        loss_weights.append(config["model"]["loss_weight_topic"])
+    if config["model"]["length_loss"]:
+        loss_weights.append(config["model"]["loss_weight_length"])
+
+    parameters = filter(lambda p: p.requires_grad, model.parameters())
+    optimizer = torch.optim.Adam(parameters, lr=config["lr"])
+
+    loader = preload(data, Seq2SeqCollate(), batch_size, steps + 1)
+    trainer = Seq3Trainer(model, loader, loader, nn.CrossEntropyLoss(),
+                          optimizer, config, device,
+                          loss_weights=loss_weights, oracle=oracle)
+
+    times, tokens = _timed_epoch(trainer, 4, device)
+
+    # skip the first (warm-up) step
+    return _summary(times[1:], tokens[1:], batch_size * steps)
+
+
+def bench_lm_train(batch_size, seq_len, vocab_size, steps, device):
+    """
+    Training steps (forward, backward and update) of the SeqReader LM,
+    of model_configs/lm.yaml.
+    """
+    config = load_model_config("lm.yaml", batch_size, seq_len)
+
+    corpus = synthetic_corpus(batch_size * (steps + 1), seq_len, vocab_size)
+    data = SentenceLMDataset(corpus, preprocess=str.split,
+                             vocab_size=vocab_size, seq_len=seq_len,
+                             sos=config["data"]["sos"],
+                             oovs=config["data"]["oovs"], verbose=False)
+
+    model = SeqReader(len(data.vocab), **config["model"])
+    model.to(device)
+
+    optimizer = torch.optim.Adam(model.parameters(), lr=config["lr"])
+
+    loader = preload(data, LMCollate(), batch_size, steps + 1)
+    trainer = LMTrainer(model, loader, loader,
+                        nn.CrossEntropyLoss(ignore_index=0),
+                        optimizer, config, device)
+
+    times, tokens = _timed_epoch(trainer, 2, device)
+
+    return _summary(times[1:], tokens[1:], batch_size * steps)
+
+
+def bench_seq3_generate(batch_size, seq_len, vocab_size, steps, device):
+    """
+    Inference (compression) with Seq2Seq2Seq.generate.
+    """
+    config = load_model_config("seq3.yaml", batch_size, seq_len)
+
+    corpus = synthetic_corpus(batch_size * (steps + 1), seq_len, vocab_size)
+    data = AEDataset(corpus, preprocess=str.split, vocab_size=vocab_size,
+                     seq_len=seq_len, oovs=config["data"]["oovs"],
+                     verbose=False)
+
+    model = Seq2Seq2Seq(len(data.vocab), **config["model"])
+    model.to(device)
+    model.eval()
+
+    loader = preload(data, Seq2SeqCollate(), batch_size, steps + 1)
+    cfg = config["model"]
+
+    times, tokens = [], []
+    with torch.no_grad():
+        for batch in loader:
+            start = time.perf_counter()
+
+            inp_src, src_lengths = batch[0].to(device), batch[4].to(device)
+            latent_lengths = (src_lengths.float() * cfg["test_min_ratio"])
+            latent_lengths = latent_lengths.long().clamp(
+                min=cfg["test_min_length"], max=cfg["test_max_length"])
+            model.generate(inp_src, src_lengths, latent_lengths)
+
+            _sync(device)
+            times.append(time.perf_counter() - start)
+            tokens.append(int(batch[4].sum()))
+
+    return _summary(times[1:], tokens[1:], batch_size * steps)
+
+
+def bench_data_pipeline(batch_size, seq_len, vocab_size, steps, device):
+    """
+    The data pipeline of the training of seq3:
+    AEDataset.__getitem__ and Seq2SeqCollate.
+    """
+    corpus = synthetic_corpus(batch_size * steps, seq_len, vocab_size)
+    data = AEDataset(corpus, preprocess=str.split, vocab_size=vocab_size,
+                     seq_len=seq_len, oovs=10, verbose=False)
+    collate = Seq2SeqCollate()
+
+    times, tokens = [], []
+    for i in range(0, len(data), batch_size):
+        start = time.perf_counter()
+        batch = collate([data[j] for j in range(i, i + batch_size)])
+        times.append(time.perf_counter() - start)
+        tokens.append(int(batch[4].sum()))
+
+    return _summary(times, tokens, batch_size * steps)
+
+
+BENCHMARKS = {
+    "seq3_train": bench_seq3_train,
+    "lm_train": bench_lm_train,
+    "seq3_generate": bench_seq3_generate,
+    "data_pipeline": bench_data_pipeline,
+}
+
+
+def _peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+def _child(conn, name, kwargs):
+    try:
+        torch.manual_seed(0)
+        result = BENCHMARKS[name](**kwargs)
+        result["peak_rss_mb"] = _peak_rss_mb()
+        conn.send(result)
+    except Exception:
+        conn.send({"error": traceback.format_exc()})
+    finally:
+        conn.close()
+
+
+def run_isolated(name, **kwargs):
+    """
+    Run a benchmark in a fresh (forked) process, so that its peak RSS
+    is not affected by the other benchmarks.
+    """
+    ctx = multiprocessing.get_context("fork")
+    parent, child = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_child, args=(child, name, kwargs))
+    process.start()
+    child.close()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+def case_name(name, batch_size, seq_len, vocab_size):
+    return f"{name}/b{batch_size}_l{seq_len}_v{vocab_size}"
+
+
+# for each metric, whether higher values are better
+METRICS = {
+    "step_ms": False,
+    "tokens_per_sec": True,
+    "peak_rss_mb": False,
+}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the results with a baseline and return the table of the
+    comparisons and the list of regressions, i.e. the metrics that are
+    worse than the baseline by more than `tolerance` (relative).
+    """
+    rows, regressions = [], []
+    for case, result in sorted(results.items()):
+        if case not in baseline or "error" in result:
+            continue
+        for metric, higher in METRICS.items():
+            old, new = baseline[case].get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+
+            change = (new - old) / old
+            regression = -change > tolerance if higher else change > tolerance
+            rows.append([case, metric, old, new, f"{change:+.1%}",
+                         "REGRESSION" if regression else ""])
+            if regression:
+                regressions.append((case, metric))
+
+    table = tabulate(rows, floatfmt=".2f",
+                     headers=["case", "metric", "baseline", "current",
+                              "change", ""])
+    return table, regressions
+
+
+def write_results(file, results, meta):
+    with open(file, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+
+
+def read_results(file):
+    with open(file) as f:
+        return json.load(f)["results"]
@@ -1,3 +1,3 @@
-from utils.load_embeddings import load_word_vectors
+from utils.load_embeddings import build_word_vectors_cache
 
-load_word_vectors("GoogleNews-vectors-negative300.txt", 300)
+build_word_vectors_cache("GoogleNews-vectors-negative300.txt", 300)
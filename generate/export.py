@@ -0,0 +1,28 @@
+"""
+Export a slim, inference-only version of a trained SEQ^3 checkpoint,
+which can be used by `compress_seq3` for generating compressions.
+It drops the weights that are used only during training
+(cmp_encoder, decompressor, trg_bridge), the optimizer states
+and the token frequencies of the vocabulary.
+
+Usage:
+    python generate/export.py --checkpoint seq3.full
+"""
+import argparse
+
+from modules.models import Seq2Seq2Seq
+from utils.training import load_checkpoint, save_inference_checkpoint
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--checkpoint', required=True)
+parser.add_argument('--name')
+args = parser.parse_args()
+
+if args.name is None:
+    args.name = args.checkpoint
+
+checkpoint = load_checkpoint(args.checkpoint)
+weights = Seq2Seq2Seq.inference_state_dict(checkpoint["model"])
+
+save_inference_checkpoint(weights, checkpoint["config"], checkpoint["vocab"],
+                          args.name, verbose=True)
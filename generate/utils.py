@@ -1,6 +1,7 @@
 import math
-from itertools import groupby
+import os
 
+import numpy
 import torch
 from torch.utils.data import DataLoader
 from tqdm import tqdm
@@ -8,12 +9,21 @@ from tqdm import tqdm
 from modules.data.collates import Seq2SeqOOVCollate
 from modules.data.datasets import AEDataset
 from modules.models import Seq2Seq2Seq
-from utils.training import load_checkpoint
+from utils.training import load_checkpoint, load_inference_checkpoint, \
+    inference_checkpoint_dir
 
 
 def compress_seq3(checkpoint, src_file, out_file,
                   device, verbose=False, mode="attention"):
-    checkpoint = load_checkpoint(checkpoint)
+    # generating compressions requires only the first encoder-decoder pair,
+    # so prefer the slim (exported) checkpoint, if it exists
+    inference = mode not in ["attention", "debug"]
+
+    if inference and os.path.isdir(inference_checkpoint_dir(checkpoint)):
+        checkpoint = load_inference_checkpoint(checkpoint)
+    else:
+        checkpoint = load_checkpoint(checkpoint)
+
     config = checkpoint["config"]
     vocab = checkpoint["vocab"]
 
@@ -30,8 +40,20 @@ def compress_seq3(checkpoint, src_file, out_file,
     data_loader = DataLoader(dataset, batch_size=config["batch_size"],
                              num_workers=0, collate_fn=Seq2SeqOOVCollate())
     n_tokens = len(dataset.vocab)
-    model = Seq2Seq2Seq(n_tokens, **config["model"]).to(device)
-    model.load_state_dict(checkpoint["model"])
+
+    # the checkpoints of older versions do not save whether the model used
+    # (shared) pretrained embeddings
+    config["model"].setdefault("pretrained_embeddings",
+                               bool(config["vocab"].get("embeddings")))
+    model = Seq2Seq2Seq(n_tokens, inference=inference, **config["model"])
+
+    if inference:
+        model.load_state_dict(
+            Seq2Seq2Seq.inference_state_dict(checkpoint["model"]))
+    else:
+        model.load_state_dict(checkpoint["model"])
+
+    model.to(device)
     model.eval()
 
     ##############################################
@@ -44,7 +66,8 @@ def compress_seq3(checkpoint, src_file, out_file,
         iterator = enumerate(data_loader, 1)
 
     def devect(ids, oov, strip_eos, pp):
-        return devectorize(ids.tolist(), vocab.id2tok, vocab.tok2id[vocab.EOS],
+        return devectorize(ids.cpu().numpy(), vocab.token_array(),
+                           vocab.tok2id[vocab.EOS],
                            strip_eos=strip_eos, oov_map=oov, pp=pp)
 
     def id2txt(ids, oov=None, lengths=None, strip_eos=True):
@@ -74,13 +97,12 @@ def compress_seq3(checkpoint, src_file, out_file,
 
                     outputs = model(inp_src, inp_trg, src_lengths, trg_lengths,
                                     sampling=0)
-                    enc1, dec1, enc2, dec2 = outputs
 
                     if mode == "debug":
 
                         src = id2txt(inp_src)
-                        latent = id2txt(dec1[3].max(-1)[1])
-                        rec = id2txt(dec2[0].max(-1)[1])
+                        latent = id2txt(outputs.dec1.dists.max(-1)[1])
+                        rec = id2txt(outputs.dec2.logits.max(-1)[1])
 
                         _results = list(zip(src, latent, rec))
 
@@ -89,12 +111,13 @@ def compress_seq3(checkpoint, src_file, out_file,
 
                     elif mode == "attention":
                         src = devect(inp_src, None, strip_eos=False, pp=False)
-                        latent = devect(dec1[3].max(-1)[1],
+                        latent = devect(outputs.dec1.dists.max(-1)[1],
                                         None, strip_eos=False, pp=False)
-                        rec = devect(dec2[0].max(-1)[1],
+                        rec = devect(outputs.dec2.logits.max(-1)[1],
                                      None, strip_eos=False, pp=False)
 
-                        _results = [src, latent, dec1[4], rec, dec2[4]]
+                        _results = [src, latent, outputs.dec1.attentions, rec,
+                                    outputs.dec2.attentions]
 
                         results += list(zip(*_results))
 
@@ -106,7 +129,7 @@ def compress_seq3(checkpoint, src_file, out_file,
                     enc1, dec1 = model.generate(inp_src, src_lengths,
                                                 trg_lengths)
 
-                    preds = id2txt(dec1[0].max(-1)[1],
+                    preds = id2txt(dec1.logits.max(-1)[1],
                                    batch_oov_map, trg_lengths.tolist())
 
                     for sample in preds:
@@ -114,19 +137,77 @@ def compress_seq3(checkpoint, src_file, out_file,
     return results
 
 
+def _pad_rows(data):
+    """
+    Convert a list of (possibly ragged) rows of ids to a 2D matrix,
+    padded with -1, along with the length of each row.
+    """
+    if isinstance(data, numpy.ndarray) and data.ndim == 2:
+        return data, numpy.full(len(data), data.shape[1])
+
+    lengths = numpy.array([len(row) for row in data])
+    if len(set(lengths)) == 1:
+        return numpy.array(data).reshape(len(data), -1), lengths
+
+    ids = numpy.full((len(data), lengths.max()), -1, dtype=numpy.int64)
+    for i, row in enumerate(data):
+        ids[i, :len(row)] = row
+
+    return ids, lengths
+
+
+def _lookup_table(id2tok, size):
+    """
+    Build an id -> token lookup table (numpy array), from a dict or
+    from an existing table. Unknown ids map to "<unk>".
+    """
+    if isinstance(id2tok, dict):
+        size = max([size] + [i + 1 for i in id2tok])
+        table = numpy.full(size, "<unk>", dtype=object)
+        table[list(id2tok.keys())] = list(id2tok.values())
+    else:
+        table = numpy.asarray(id2tok, dtype=object)
+        if len(table) < size:
+            padding = numpy.full(size - len(table), "<unk>", dtype=object)
+            table = numpy.concatenate([table, padding])
+
+    return table
+
+
 def devectorize(data, id2tok, eos, strip_eos=True, oov_map=None, pp=True):
+    """
+    Convert a batch of ids to tokens.
+    All the operations are performed on the (padded) id matrix and only
+    the positions of OOV tokens are handled individually.
+
+    Args:
+        data (list, numpy.ndarray): list of rows of ids or a 2D id matrix
+        id2tok (dict, numpy.ndarray): the id -> token mapping or
+            a lookup table (e.g. `Vocab.token_array()`)
+        eos (int): the id of the EOS token
+        strip_eos (bool): strip each row at its first EOS token
+        oov_map (list): list with the OOV map (dict) of each row
+        pp (bool): post-process the outputs, by replacing special tokens and
+            removing consecutive repetitions
+
+    Returns: list of lists of tokens
+
+    """
+    if len(data) == 0:
+        return []
+
+    ids, lengths = _pad_rows(data)
+
+    if ids.size == 0:
+        return [[] for _ in range(len(ids))]
+
     if strip_eos:
-        for i in range(len(data)):
-            try:
-                data[i] = data[i][:list(data[i]).index(eos)]
-            except:
-                continue
+        is_eos = ids == eos
+        lengths = numpy.where(is_eos.any(1), is_eos.argmax(1), lengths)
 
     # ids to words
-    data = [[id2tok.get(x, "<unk>") for x in seq] for seq in data]
-
-    if oov_map is not None:
-        data = [[m.get(x, x) for x in seq] for seq, m in zip(data, oov_map)]
+    table = _lookup_table(id2tok, int(ids.max()) + 1)
+    words = table[ids]
 
     if pp:
         rules = {f"<oov-{i}>": "UNK" for i in range(10)}
@@ -136,9 +217,26 @@ def devectorize(data, id2tok, eos, strip_eos=True, oov_map=None, pp=True):
         rules["<eos>"] = ""
         rules["<pad>"] = ""
 
-        data = [[rules.get(x, x) for x in seq] for seq in data]
+        words = numpy.array([rules.get(x, x) for x in table],
+                            dtype=object)[ids]
+
+    if oov_map is not None:
+        # replace only the positions of the tokens that are in an OOV map
+        oov_keys = set().union(*oov_map)
+        oov_ids = [i for i, x in enumerate(table) if x in oov_keys]
+        positions = numpy.isin(ids, oov_ids)
+        positions &= numpy.arange(ids.shape[1]) < lengths[:, None]
 
+        for r, c in zip(*numpy.nonzero(positions)):
+            x = oov_map[r].get(table[ids[r, c]], table[ids[r, c]])
+            words[r, c] = rules.get(x, x) if pp else x
+
+    if pp:
         # remove repetitions
-        data = [[x[0] for x in groupby(seq)] for seq in data]
+        keep = numpy.ones(words.shape, dtype=bool)
+        keep[:, 1:] = words[:, 1:] != words[:, :-1]
+
+        return [row[:l][k[:l]].tolist()
+                for row, k, l in zip(words, keep, lengths)]
 
-    return data
+    return [row[:l].tolist() for row, l in zip(words, lengths)]
@@ -14,7 +14,7 @@ from modules.data.samplers import SortedSampler, BucketBatchSampler
 from modules.data.vocab import Vocab
 from modules.modules import SeqReader
 from mylogger.experiment import Experiment
-from sys_config import EXP_DIR, MODEL_CNF_DIR
+from sys_config import EXP_DIR, MODEL_CNF_DIR, print_environment
 from utils.generic import number_h
 from utils.opts import train_options
 from utils.training import load_checkpoint
@@ -23,6 +23,7 @@ from utils.training import load_checkpoint
 # SETTINGS
 ####################################################################
 opts, config = train_options()
+print_environment()
 
 ####################################################################
 # Data Loading and Preprocessing
@@ -59,6 +60,7 @@ train_set = SentenceLMDataset(config["data"]["train_path"],
                               subword_path=config["vocab"]["subword_path"],
                               vocab=vocab,
                               vocab_size=config["vocab"]["size"],
+                              vocab_max_types=config["vocab"].get("max_types"),
                               seq_len=config["data"]["seq_len"],
                               sos=config["data"]["sos"],
                               oovs=config["data"].get("oovs", 0))
@@ -73,12 +75,12 @@ val_set = SentenceLMDataset(config["data"]["val_path"],
                             sos=config["data"]["sos"],
                             oovs=config["data"].get("oovs", 0))
 
-src_lengths = [len(x) for x in train_set.data]
-val_lengths = [len(x) for x in val_set.data]
+src_lengths = train_set.data.lengths
+val_lengths = val_set.data.lengths
 
 train_sampler = BucketBatchSampler(src_lengths, config["batch_size"],
                                    shuffle=True)
-val_sampler = SortedSampler(val_lengths)
+val_sampler = SortedSampler(val_lengths, descending=True)
 
 train_loader = DataLoader(train_set, batch_sampler=train_sampler,
                           num_workers=0, collate_fn=LMCollate())
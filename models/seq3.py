@@ -1,7 +1,7 @@
 import itertools
 import math
 import os
-import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy
 import torch
@@ -13,14 +13,16 @@ from torch.utils.data import DataLoader
 from generate.utils import devectorize
 from models.seq3_trainer import Seq3Trainer
 from models.seq3_utils import compute_dataset_idf
-from modules.data.collates import Seq2SeqCollate, Seq2SeqOOVCollate
+from modules.data.collates import Seq2SeqCollate, Seq2SeqOOVCollate, \
+    TokenNoise
 from modules.data.datasets import AEDataset
-from modules.data.samplers import BucketBatchSampler
+from modules.data.loaders import MultiLoader, worker_kwargs
+from modules.data.samplers import BucketBatchSampler, SortedSampler
 from modules.models import Seq2Seq2Seq
 from modules.modules import SeqReader
 from mylogger.attention import samples2html
 from mylogger.experiment import Experiment
-from sys_config import EXP_DIR, EMBS_PATH, MODEL_CNF_DIR
+from sys_config import EXP_DIR, EMBS_PATH, MODEL_CNF_DIR, print_environment
 from utils.eval import rouge_file_list, pprint_rouge_scores
 from utils.generic import number_h
 from utils.opts import seq2seq2seq_options
@@ -31,6 +33,7 @@ from utils.transfer import freeze_module
 # Settings
 ####################################################################
 opts, config = seq2seq2seq_options()
+print_environment()
 
 ####################################################################
 #
@@ -61,65 +64,100 @@ def giga_tokenizer(x):
     return x.strip().lower().split()
 
 
+# the training data may be a list of corpora, which are mixed (MultiLoader).
+# The vocabulary is built from the first (primary) corpus.
+train_paths = config["data"]["train_path"]
+if not isinstance(train_paths, list):
+    train_paths = [train_paths]
+
 print("Building training dataset...")
-train_data = AEDataset(config["data"]["train_path"],
+train_data = AEDataset(train_paths[0],
                        preprocess=giga_tokenizer,
                        vocab=vocab,
                        vocab_size=config["vocab"]["size"],
+                       vocab_max_types=config["vocab"].get("max_types"),
                        seq_len=config["data"]["seq_len"],
-                       oovs=config["data"]["oovs"],
-                       swaps=config["data"]["swaps"])
+                       oovs=config["data"]["oovs"])
+
+extra_train_data = []
+for path in train_paths[1:]:
+    print(f"Building training dataset ({os.path.basename(path)})...")
+    extra_train_data.append(AEDataset(path,
+                                      preprocess=giga_tokenizer,
+                                      vocab=train_data.vocab,
+                                      seq_len=config["data"]["seq_len"],
+                                      oovs=config["data"]["oovs"]))
 
 print("Building validation dataset...")
 val_data = AEDataset(config["data"]["val_path"],
                      preprocess=giga_tokenizer,
-                     vocab=vocab,
-                     vocab_size=config["vocab"]["size"],
+                     vocab=train_data.vocab,
                      seq_len=config["data"]["seq_len"],
                      return_oov=True,
                      oovs=config["data"]["oovs"])
 
-val_data.vocab = train_data.vocab
 vocab = train_data.vocab
 
+# the noise of the source texts, which is added to each batch
+noise = TokenNoise(swaps=config["data"]["swaps"],
+                   shuffle=config["data"].get("shuffle", 0.0),
+                   dropout=config["data"].get("word_dropout", 0.0),
+                   unk=vocab.tok2id[vocab.UNK])
+
+
 # define a dataloader, which handles the way a dataset will be loaded,
 # like batching, shuffling and so on ...
-train_lengths = [len(x) for x in train_data.data]
-
-train_sampler = BucketBatchSampler(train_lengths, config["batch_size"])
-train_loader = DataLoader(train_data, batch_sampler=train_sampler,
-                          num_workers=config["num_workers"],
-                          collate_fn=Seq2SeqCollate())
-val_loader = DataLoader(val_data, batch_size=config["batch_size"],
-                        num_workers=config["num_workers"], shuffle=False,
-                        collate_fn=Seq2SeqOOVCollate())
+def train_dataloader(dataset):
+    sampler = BucketBatchSampler(dataset.data.lengths, config["batch_size"])
+    return DataLoader(dataset, batch_sampler=sampler,
+                      collate_fn=Seq2SeqCollate(noise=noise),
+                      **worker_kwargs(config["num_workers"]))
+
+
+val_lengths = val_data.data.lengths
+val_sampler = SortedSampler(val_lengths, descending=True)
+
+train_loader = train_dataloader(train_data)
+if len(extra_train_data) > 0:
+    train_loaders = [train_loader] + [train_dataloader(x)
+                                      for x in extra_train_data]
+    train_loader = MultiLoader(train_loaders,
+                               weights=config["data"].get("weights"),
+                               temperature=config["data"].get("temperature",
+                                                              1))
+val_loader = DataLoader(val_data, sampler=val_sampler,
+                        batch_size=config["batch_size"],
+                        collate_fn=Seq2SeqOOVCollate(),
+                        **worker_kwargs(config["num_workers"]))
 
 ####################################################################
 #
 # Model Definition
 # - additional layer initializations
-# - weight / layer tying
+# - (the weight / layer tying is done by the model, based on the config)
 #
 ####################################################################
 
-# Define the model
+# Define the model. The pretrained embeddings are shared by all the layers.
+# The flag is saved in the config of the model (and of the checkpoints),
+# so that the same layers are built when the model is loaded for inference.
+pretrained = bool(config["vocab"].get("embeddings"))
+config["model"]["pretrained_embeddings"] = pretrained
 n_tokens = len(train_data.vocab)
 model = Seq2Seq2Seq(n_tokens, **config["model"])
 criterion = nn.CrossEntropyLoss(ignore_index=0)
 
 # Load Pretrained Word Embeddings
-if "embeddings" in config["vocab"] and config["vocab"]["embeddings"]:
+if pretrained:
     emb_file = os.path.join(EMBS_PATH, config["vocab"]["embeddings"])
     dims = config["vocab"]["embeddings_dim"]
 
     embs, emb_mask, missing = train_data.vocab.read_embeddings(emb_file, dims)
     model.initialize_embeddings(embs, config["model"]["embed_trainable"])
 
-    # initialize the output layers with the pretrained embeddings,
-    # regardless of whether they will be tied
+    # initialize the (untied) output layers with the pretrained embeddings
     try:
-        model.compressor.Wo.weight.data.copy_(torch.from_numpy(embs))
-        model.decompressor.Wo.weight.data.copy_(torch.from_numpy(embs))
+        model.initialize_output_embeddings(embs)
     except:
         print("Can't init outputs from embeddings. Dim mismatch!")
 
@@ -134,42 +172,6 @@ if config["model"]["topic_loss"] and config["model"]["topic_idf"]:
     idf[vocab.tok2id[vocab.PAD]] = 1  # neutralize padding token
     model.initialize_embeddings_idf(idf)
 
-####################################################################
-#
-# Tie Models
-#
-####################################################################
-# tie the embedding layers
-if config["model"]["tie_embedding"]:
-    model.cmp_encoder.embed = model.inp_encoder.embed
-    model.compressor.embed = model.inp_encoder.embed
-    model.decompressor.embed = model.inp_encoder.embed
-
-# tie the output layers of the decoders
-if config["model"]["tie_decoder_outputs"]:
-    model.compressor.Wo = model.decompressor.Wo
-
-# tie the embedding to the output layers
-if config["model"]["tie_embedding_outputs"]:
-    emb_size = model.compressor.embed.embedding.weight.size(1)
-    rnn_size = model.compressor.Wo.weight.size(1)
-
-    if emb_size != rnn_size:
-        warnings.warn("Can't tie outputs, since emb_size != rnn_size.")
-    else:
-        model.compressor.Wo.weight = model.inp_encoder.embed.embedding.weight
-        model.decompressor.Wo.weight = model.inp_encoder.embed.embedding.weight
-
-if config["model"]["tie_decoders"]:
-    model.compressor = model.decompressor
-
-if config["model"]["tie_encoders"]:
-    model.cmp_encoder = model.inp_encoder
-
-# then we need only one bridge
-if config["model"]["tie_encoders"] and config["model"]["tie_decoders"]:
-    model.src_bridge = model.trg_bridge
-
 ####################################################################
 #
 # Experiment Logging and Visualization
@@ -228,6 +230,18 @@ exp.add_value("weights", "text")
 exp.add_value("rouge-stats", "text")
 exp.add_value("states", "scatter")
 exp.add_metric("lr", "line", "Learning Rate")
+
+# per-phase timings of the training steps
+step_phases = ["data", "to_device", "forward", "aggregate", "backward",
+               "optimizer", "callbacks", "total"]
+if config["model"]["clip"] is not None:
+    step_phases.insert(5, "clip")
+loss_phases = ["model", "reconstruction"] + [t.lower() for t in step_tags[1:]]
+exp.add_metric("step_time", "line", title="Step Time (ms, p50)",
+               tags=step_phases)
+exp.add_metric("loss_time", "line", title="Loss Time (ms, p50)",
+               tags=loss_phases)
+exp.add_value("profile", "text", title="step profile")
 exp.add_value("rouge-stats", "text")
 
 
@@ -255,6 +269,14 @@ def stats_callback(batch, losses, loss_list, batch_outputs):
             exp.update_metric("loss", loss, tag)
             exp.update_metric("ppl", math.exp(loss), tag)
 
+        # log the timings of the training steps
+        timings = trainer.profiler.percentiles()
+        for key in ["step_time", "loss_time"]:
+            for tag in exp.get_metric(key).tags:
+                if tag in timings:
+                    exp.update_metric(key, timings[tag]["p50"], tag)
+        exp.update_value("profile", trainer.profiler.summary())
+
         ################################################
 
         losses_log = exp.log_metrics(["loss", "ppl"])
@@ -266,88 +288,138 @@ def stats_callback(batch, losses, loss_list, batch_outputs):
 
 
 def samples_to_text(tensor):
-    return devectorize(tensor.tolist(), train_data.vocab.id2tok,
+    return devectorize(tensor.cpu().numpy(), train_data.vocab.token_array(),
                        train_data.vocab.tok2id[vocab.EOS],
                        strip_eos=False, pp=False)
 
 
-def outs_callback(batch, losses, loss_list, batch_outputs):
-    if trainer.step % config["log_interval"] == 0:
-        enc1, dec1, enc2, dec2 = batch_outputs['model_outputs']
+# the samples are rendered in a background worker, from a (CPU) snapshot
+# of the first few samples of the batch, every `sample_interval` steps
+sample_interval = config.get("sample_interval", config["log_interval"])
+n_samples = config.get("samples", 5)
+sample_worker = ThreadPoolExecutor(max_workers=1)
+sample_job = None
 
-        if config["plot_norms"]:
-            norms = batch_outputs['grad_norm']
-            exp.update_metric("c_norm", norms[0], "REC")
 
-            if "TOPIC" in step_tags:
-                exp.update_metric("c_norm", norms[loss_ids["topic"]], "TOPIC")
+def snapshot_samples(batch, batch_outputs):
+    """
+    Copy to the CPU only the outputs that are needed for rendering
+    the first `n_samples` samples of the batch.
+    """
+    outputs = batch_outputs['model_outputs']
+    k = n_samples
 
-            if "PRIOR" in step_tags:
-                exp.update_metric("c_norm", norms[loss_ids["prior"]], "PRIOR")
+    if len(batch) == 2:
+        inp = batch[0][0]
+    else:
+        inp = batch[0]
+
+    snapshot = {
+        "src": inp[:k],
+        "hyp": outputs.dec1.dists[:k].max(dim=2)[1],
+        "rec": outputs.dec2.logits[:k].max(dim=2)[1],
+        "rec_losses": batch_outputs['reconstruction'][:k],
+    }
+
+    # prior outputs
+    if "prior" in batch_outputs:
+        prior_loss, prior_logits = batch_outputs['prior']
+        prior_logits = prior_logits[:k]
+        snapshot["prior_loss"] = prior_loss[:k]
+        snapshot["prior"] = prior_logits.max(dim=2)[1]
+        snapshot["prior_entropy"] = Categorical(
+            logits=prior_logits).entropy()
+
+    if "attention" in batch_outputs and \
+            batch_outputs['attention'][0] is not None:
+        snapshot["att_scores"] = batch_outputs['attention'][0][:k].squeeze(-1)
+
+    if config["model"]["learn_tau"]:
+        snapshot["temps"] = outputs.dec1.taus[:k]
+
+    return {key: v.detach().cpu() for key, v in snapshot.items()}
+
+
+def render_samples(snapshot):
+    src = samples_to_text(snapshot["src"])
+    hyp = samples_to_text(snapshot["hyp"])
+    rec = samples_to_text(snapshot["rec"])
+    rec_losses = snapshot["rec_losses"].tolist()
+
+    if "prior" in snapshot:
+        prior = samples_to_text(snapshot["prior"])
+        prior_loss = snapshot["prior_loss"].tolist()
+        prior_entropy = snapshot["prior_entropy"].tolist()
+
+    if "att_scores" in snapshot:
+        att_scores = snapshot["att_scores"].tolist()
+    else:
+        att_scores = None
 
-        if len(batch) == 2:
-            inp = batch[0][0]
-        else:
-            inp = batch[0]
-        src = samples_to_text(inp)
-        hyp = samples_to_text(dec1[3].max(dim=2)[1])
-        rec = samples_to_text(dec2[0].max(dim=2)[1])
+    if "temps" in snapshot:
+        temps = snapshot["temps"].numpy().round(2)
+    else:
+        temps = None
 
-        # prior outputs
-        if "prior" in batch_outputs:
-            prior_loss = batch_outputs['prior'][0].squeeze().tolist()
-            prior_logits = batch_outputs['prior'][1]
+    samples = []
+    for i in range(len(src)):
+        sample = []
 
-            prior_argmax = prior_logits.max(dim=2)[1]
-            prior_entropy = Categorical(logits=prior_logits).entropy().tolist()
+        if att_scores is not None:
+            _src = 'SRC', (src[i], att_scores[i]), "255, 0, 0"
+        else:
+            _src = 'SRC', src[i], "0, 0, 0"
+        sample.append(_src)
+
+        if "prior" in snapshot:
+            _hyp = 'HYP', (hyp[i], prior_loss[i]), "0, 0, 255"
+            _pri = 'LM ', (prior[i], prior_entropy[i]), "0, 255, 0"
+            sample.append(_hyp)
+            sample.append(_pri)
+        else:
+            _hyp = 'HYP', hyp[i], "0, 0, 255"
+            sample.append(_hyp)
 
-            prior = samples_to_text(prior_argmax)
+        if temps is not None:
+            _tmp = 'TMP', (list(map(str, temps[i])), temps[i]), "255, 0, 0"
+            sample.append(_tmp)
 
-        if "attention" in batch_outputs:
-            att_scores = batch_outputs['attention'][0].squeeze().tolist()
-        else:
-            att_scores = None
+        _rec = 'REC', (rec[i], rec_losses[i]), "255, 0, 0"
+        sample.append(_rec)
 
-        if config["model"]["learn_tau"]:
-            temps = dec1[5].cpu().data.numpy().round(2)
-        else:
-            temps = None
+        samples.append(sample)
 
-        rec_losses = batch_outputs['reconstruction'].tolist()
+    html_samples = samples2html(samples)
+    exp.update_value("samples", html_samples)
+    with open(os.path.join(EXP_DIR, f"{opts.name}.samples.html"),
+              'w') as f:
+        f.write(html_samples)
 
-        samples = []
-        for i in range(len(src)):
-            sample = []
 
-            if att_scores is not None:
-                _src = 'SRC', (src[i], att_scores[i]), "255, 0, 0"
-            else:
-                _src = 'SRC', src[i], "0, 0, 0"
-            sample.append(_src)
+def outs_callback(batch, losses, loss_list, batch_outputs):
+    global sample_job
 
-            if "prior" in batch_outputs:
-                _hyp = 'HYP', (hyp[i], prior_loss[i]), "0, 0, 255"
-                _pri = 'LM ', (prior[i], prior_entropy[i]), "0, 255, 0"
-                sample.append(_hyp)
-                sample.append(_pri)
-            else:
-                _hyp = 'HYP', hyp[i], "0, 0, 255"
-                sample.append(_hyp)
+    if trainer.step % config["log_interval"] == 0:
+        if config["plot_norms"]:
+            norms = batch_outputs['grad_norm']
+            exp.update_metric("c_norm", norms[0], "REC")
 
-            if temps is not None:
-                _tmp = 'TMP', (list(map(str, temps[i])), temps[i]), "255, 0, 0"
-                sample.append(_tmp)
+            if "TOPIC" in step_tags:
+                exp.update_metric("c_norm", norms[loss_ids["topic"]], "TOPIC")
 
-            _rec = 'REC', (rec[i], rec_losses[i]), "255, 0, 0"
-            sample.append(_rec)
+            if "PRIOR" in step_tags:
+                exp.update_metric("c_norm", norms[loss_ids["prior"]], "PRIOR")
 
-            samples.append(sample)
+    if trainer.step % sample_interval == 0:
+        if sample_job is not None:
+            # skip the samples, if the previous ones are still being rendered
+            if not sample_job.done():
+                return
+            # raise any error of the rendering
+            sample_job.result()
 
-        html_samples = samples2html(samples)
-        exp.update_value("samples", html_samples)
-        with open(os.path.join(EXP_DIR, f"{opts.name}.samples.html"),
-                  'w') as f:
-            f.write(html_samples)
+        snapshot = snapshot_samples(batch, batch_outputs)
+        sample_job = sample_worker.submit(render_samples, snapshot)
 
 
 def eval_callback(batch, losses, loss_list, batch_outputs):
@@ -362,8 +434,13 @@ def eval_callback(batch, losses, loss_list, batch_outputs):
         preds = list(itertools.chain.from_iterable(preds))
         oov_maps = list(itertools.chain.from_iterable(oov_maps))
 
+        # revert the predictions to the order of the references
+        preds = val_sampler.unsort(preds)
+        oov_maps = val_sampler.unsort(oov_maps)
+
         v = train_data.vocab
-        tokens = devectorize(preds, v.id2tok, v.tok2id[v.EOS], True, oov_maps)
+        tokens = devectorize(preds, v.token_array(), v.tok2id[v.EOS], True,
+                             oov_maps)
         hyps = [" ".join(x) for x in tokens]
         scores = rouge_file_list(config["data"]["ref_path"], hyps)
 
@@ -424,3 +501,5 @@ for epoch in range(config["epochs"]):
 
     # Save the model if the validation loss is the best we've seen so far.
     save_best()
+
+sample_worker.shutdown()
@@ -3,7 +3,8 @@ from torch.nn import functional as F
 
 from models.seq3_losses import _kl_div, kl_length, pairwise_loss
 from models.seq3_utils import sample_lengths
-from modules.helpers import sequence_mask, avg_vectors, module_grad_wrt_loss
+from modules.helpers import sequence_mask, avg_vectors, module_params, \
+    grads_wrt_loss, mean_grad_norm, chunked_cross_entropy
 from modules.training.trainer import Trainer
 
 
@@ -23,36 +24,69 @@ class Seq3Trainer(Trainer):
         self.len_min = self.anneal_init(self.config["model"]["min_length"])
         self.len_max = self.anneal_init(self.config["model"]["max_length"])
 
+        # compute the reconstruction loss in chunks of N timesteps,
+        # without materializing the full logits of the decompressor
+        self.chunked_loss = self.config["model"].get("chunked_loss", 0)
+
+        # how often and how many samples of the outputs are inspected
+        self.sample_interval = self.config.get("sample_interval",
+                                               self.log_interval)
+        self.n_samples = self.config.get("samples", 5)
+
     def _debug_grads(self):
         return list(sorted([(n, p.grad) for n, p in
                             self.model.named_parameters() if p.requires_grad]))
 
-    def _debug_grad_norms(self, reconstruct_loss, prior_loss, topic_loss):
-        c_grad_norm = []
-        c_grad_norm.append(
-            module_grad_wrt_loss(self.optimizers, self.model.compressor,
-                                 reconstruct_loss,
-                                 "rnn"))
+    def _debug_grad_norms(self, losses):
+        """
+        Prepare the diagnostic of the norms of the gradients of each loss
+        wrt the RNN of the compressor.
+
+        The gradients of the auxiliary losses are computed with
+        autograd.grad, restricted to the parameters of the RNN.
+        The gradient of the reconstruction loss is derived after the main
+        backward pass (see _after_backward), by subtracting the (weighted)
+        gradients of the auxiliary losses from the total gradient.
+        """
+        params = module_params(self.model.compressor, "rnn")
 
-        if self.config["model"]["topic_loss"]:
-            c_grad_norm.append(
-                module_grad_wrt_loss(self.optimizers, self.model.compressor,
-                                     topic_loss,
-                                     "rnn"))
+        if self.loss_weights is None:
+            weights = [1] * len(losses)
+        else:
+            weights = [self.anneal_step(w) for w in self.loss_weights]
 
-        if self.config["model"]["prior_loss"] and self.oracle is not None:
-            c_grad_norm.append(
-                module_grad_wrt_loss(self.optimizers, self.model.compressor,
-                                     prior_loss,
-                                     "rnn"))
-        return c_grad_norm
+        grads = [None] + [grads_wrt_loss(params, l) for l in losses[1:]]
 
-    def _topic_loss(self, inp, dec1, src_lengths, trg_lengths):
+        if weights[0] == 0:
+            grads[0] = grads_wrt_loss(params, losses[0])
+
+        return params, weights, grads
+
+    def _after_backward(self, batch_outputs):
+        if "grad_parts" not in batch_outputs:
+            return
+
+        with self.profiler.phase("grad_norms"):
+            params, weights, grads = batch_outputs.pop("grad_parts")
+
+            if grads[0] is None:
+                rec = [torch.zeros_like(p) if p.grad is None
+                       else p.grad.clone() for p in params]
+                for w, loss_grads in zip(weights[1:], grads[1:]):
+                    for r, g in zip(rec, loss_grads):
+                        r.sub_(w * g)
+                grads[0] = [r / weights[0] for r in rec]
+
+            # the norms are in the same order as the losses
+            batch_outputs["grad_norm"] = [mean_grad_norm(g) for g in grads]
+
+    def _topic_loss(self, inp, outputs, src_lengths, trg_lengths):
         """
         Compute the pairwise distance of various outputs of the seq^3 architecture.
         Args:
-            enc1: the outputs of the first encoder (input sequence)
-            dec1: the outputs of the first decoder (latent sequence)
+            inp: the input sequence
+            outputs: the outputs of the model (Seq3Output). The embeddings
+                of the input and of the latent sequence are reused.
             src_lengths: the lengths of the input sequence
             trg_lengths: the lengths of the targer sequence (summary)
 
@@ -61,12 +95,12 @@ class Seq3Trainer(Trainer):
         enc_mask = sequence_mask(src_lengths).unsqueeze(-1).float()
         dec_mask = sequence_mask(trg_lengths - 1).unsqueeze(-1).float()
 
-        enc_embs = self.model.inp_encoder.embed(inp)
-        dec_embs = self.model.compressor.embed.expectation(dec1[3])
+        enc_embs = outputs.inp_embeddings
+        dec_embs = outputs.cmp_embeddings
 
         if self.config["model"]["topic_idf"]:
             enc1_energies = self.model.idf(inp)
-            # dec1_energies = expected_vecs(dec1[3], self.model.idf.weight)
+            # dec1_energies = expected_vecs(dec1.dists, self.model.idf.weight)
 
             x_emb, att_x = avg_vectors(enc_embs, enc_mask, enc1_energies)
             # y_emb, att_y = avg_vectors(dec_reps, dec_mask, dec1_energies)
@@ -91,10 +125,10 @@ class Seq3Trainer(Trainer):
         Returns:
 
         """
-        enc1, dec1, enc2, dec2 = outputs
         _vocab = self._get_vocab()
 
-        logits_dec1, outs_dec1, hn_dec1, dists_dec1, _, _ = dec1
+        logits_dec1 = outputs.dec1.logits
+        dists_dec1 = outputs.dec1.dists
 
         # dists_dec1 contain the distributions from which
         # the samples were taken. It contains one less element than the logits
@@ -115,6 +149,32 @@ class Seq3Trainer(Trainer):
 
         return prior_loss, prior_loss_time, logits_oracle
 
+    def _chunked_reconstruction(self, outputs, labels):
+        """
+        Compute the reconstruction loss from the contexts of the
+        decompressor, in chunks of timesteps (see chunked_cross_entropy).
+
+        The logits are computed (without gradients) only in the steps,
+        in which the samples are inspected by the callbacks,
+        and only for the inspected samples.
+
+        Returns:
+            the loss of each token and the outputs, with the logits of
+            the decompressor, when they are needed
+        """
+        dec2 = outputs.dec2
+        projection = self.model.decompressor.Wo
+
+        loss = chunked_cross_entropy(dec2.contexts, projection, labels,
+                                     self.chunked_loss)
+
+        if self.step % self.sample_interval == 0:
+            with torch.no_grad():
+                logits = projection(dec2.contexts[:self.n_samples])
+            outputs = outputs._replace(dec2=dec2._replace(logits=logits))
+
+        return loss, outputs
+
     def _process_batch(self, inp_x, out_x, inp_xhat, out_xhat,
                        x_lengths, xhat_lengths):
 
@@ -131,51 +191,58 @@ class Seq3Trainer(Trainer):
                                         len_min_rt, len_max_rt,
                                         len_min, len_max)
 
-        outputs = self.model(inp_x, inp_xhat,
-                             x_lengths, latent_lengths, sampling, tau)
-
-        enc1, dec1, enc2, dec2 = outputs
+        with self.profiler.phase("model"):
+            outputs = self.model(inp_x, inp_xhat,
+                                 x_lengths, latent_lengths, sampling, tau,
+                                 hard=self.hard,
+                                 project=not self.chunked_loss)
 
-        batch_outputs = {"model_outputs": outputs}
+        batch_outputs = {}
 
         # --------------------------------------------------------------
         # 1 - RECONSTRUCTION
         # --------------------------------------------------------------
-        # reconstruct_loss = self._seq_loss(dec2[0], out_xhat)
-
-        _dec2_logits = dec2[0].contiguous().view(-1, dec2[0].size(-1))
-        _x_labels = out_xhat.contiguous().view(-1)
-        reconstruct_loss = F.cross_entropy(_dec2_logits, _x_labels,
-                                           ignore_index=0,
-                                           reduction='none')
-
-        reconstruct_loss_token = reconstruct_loss.view(out_xhat.size())
-        batch_outputs["reconstruction"] = reconstruct_loss_token
-        mean_rec_loss = reconstruct_loss.sum() / xhat_lengths.float().sum()
-        losses = [mean_rec_loss]
+        # reconstruct_loss = self._seq_loss(outputs.dec2.logits, out_xhat)
+
+        with self.profiler.phase("reconstruction"):
+            if outputs.dec2.logits is None:
+                reconstruct_loss_token, outputs = self._chunked_reconstruction(
+                    outputs, out_xhat)
+            else:
+                logits = outputs.dec2.logits
+                _dec2_logits = logits.contiguous().view(-1, logits.size(-1))
+                _x_labels = out_xhat.contiguous().view(-1)
+                reconstruct_loss = F.cross_entropy(_dec2_logits, _x_labels,
+                                                   ignore_index=0,
+                                                   reduction='none')
+                reconstruct_loss_token = reconstruct_loss.view(out_xhat.size())
+
+            batch_outputs["model_outputs"] = outputs
+            batch_outputs["reconstruction"] = reconstruct_loss_token
+            mean_rec_loss = (reconstruct_loss_token.sum()
+                             / xhat_lengths.float().sum())
+            losses = [mean_rec_loss]
 
         # --------------------------------------------------------------
         # 2 - PRIOR
         # --------------------------------------------------------------
         if self.config["model"]["prior_loss"] and self.oracle is not None:
-            prior_loss, p_loss_i, p_logits = self._prior_loss(outputs,
-                                                              latent_lengths)
+            with self.profiler.phase("prior"):
+                prior_loss, p_loss_i, p_logits = self._prior_loss(
+                    outputs, latent_lengths)
             batch_outputs["prior"] = p_loss_i, p_logits
             losses.append(prior_loss)
-        else:
-            prior_loss = None
 
         # --------------------------------------------------------------
         # 3 - TOPIC
         # --------------------------------------------------------------
         if self.config["model"]["topic_loss"]:
-            topic_loss, attentions = self._topic_loss(inp_x, dec1,
-                                                      x_lengths,
-                                                      latent_lengths)
+            with self.profiler.phase("topic"):
+                topic_loss, attentions = self._topic_loss(inp_x, outputs,
+                                                          x_lengths,
+                                                          latent_lengths)
             batch_outputs["attention"] = attentions
             losses.append(topic_loss)
-        else:
-            topic_loss = None
 
         # --------------------------------------------------------------
         # 4 - LENGTH
@@ -183,7 +250,9 @@ class Seq3Trainer(Trainer):
         if self.config["model"]["length_loss"]:
             _vocab = self._get_vocab()
             eos_id = _vocab.tok2id[_vocab.EOS]
-            length_loss = kl_length(dec1[0], latent_lengths, eos_id)
+            with self.profiler.phase("length"):
+                length_loss = kl_length(outputs.dec1.logits, latent_lengths,
+                                        eos_id)
             losses.append(length_loss)
 
         # --------------------------------------------------------------
@@ -191,10 +260,8 @@ class Seq3Trainer(Trainer):
         # --------------------------------------------------------------
         if self.config["plot_norms"] and self.step % self.config[
             "log_interval"] == 0:
-            batch_outputs["grad_norm"] = self._debug_grad_norms(
-                mean_rec_loss,
-                prior_loss,
-                topic_loss)
+            with self.profiler.phase("grad_norms"):
+                batch_outputs["grad_parts"] = self._debug_grad_norms(losses)
 
         return losses, batch_outputs
 
@@ -226,7 +293,7 @@ class Seq3Trainer(Trainer):
                 batch_oov_map = batch[-1]
                 batch = batch[:-1]
 
-                batch = list(map(lambda x: x.to(self.device), batch))
+                batch = self._tensors_to_device(batch)
                 (inp_src, out_src, inp_trg, out_trg,
                  src_lengths, trg_lengths) = batch
 
@@ -238,10 +305,10 @@ class Seq3Trainer(Trainer):
                 enc, dec = self.model.generate(inp_src, src_lengths,
                                                latent_lengths)
 
-                if dec[3] is not None:
-                    results.append(dec[3].max(dim=2)[1])
+                if dec.dists is not None:
+                    results.append(dec.dists.max(dim=2)[1])
                 else:
-                    results.append(dec[0].max(dim=2)[1])
+                    results.append(dec.logits.max(dim=2)[1])
 
                 oov_maps.append(batch_oov_map)
 
@@ -272,4 +339,7 @@ class Seq3Trainer(Trainer):
             "vocab": self._get_vocab(),
         }
 
+        if self.mixer is not None:
+            state["mixer"] = self.mixer.state_dict()
+
         return state
@@ -1,24 +1,137 @@
+import hashlib
+import os
+from multiprocessing import Pool
 from pprint import pprint
 
+import numpy
 import torch
-from sklearn.feature_extraction.text import TfidfVectorizer
 
 from generate.utils import devectorize
+from modules.data.utils import PackedCorpus
 
+# the code of the tokens, that are not in the vocab of the dataset
+_UNKNOWN = -2
 
-def compute_dataset_idf(dataset, vocab):
-    def identity_func(doc):
-        return doc
 
-    my_data = [dataset.read_sample(i) for i in range(len(dataset))]
+def _document_frequencies(args):
+    """
+    Count the number of documents (sentences) that contain each id,
+    over a chunk of the codes of a PackedCorpus.
+    """
+    codes, lengths, type_ids, specials, slots, unk, seq_len, size = args
+
+    # clip each document to seq_len tokens
+    docs = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    starts = numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+    keep = numpy.arange(len(codes)) - starts < seq_len
+    codes, docs = codes[keep], docs[keep]
+
+    ids = type_ids[codes]
+    keys = [docs[ids >= 0] * size + ids[ids >= 0]]
+
+    # the SOS and EOS tokens, which are added to each document
+    for i in specials:
+        keys.append(numpy.arange(len(lengths)) * size + i)
+
+    # the unique unknown tokens of each document take the OOV slots,
+    # in order, and the rest of them are replaced by UNK
+    unknown = ids == _UNKNOWN
+    pairs = numpy.unique(docs[unknown] * len(type_ids) + codes[unknown])
+    n_unks = numpy.bincount(pairs // len(type_ids), minlength=len(lengths))
+
+    for i, slot in enumerate(slots):
+        if slot >= 0:
+            keys.append(numpy.flatnonzero(n_unks > i) * size + slot)
+    if unk >= 0:
+        keys.append(numpy.flatnonzero(n_unks > len(slots)) * size + unk)
+
+    # count each id once per document
+    keys = numpy.unique(numpy.concatenate(keys))
+
+    return numpy.bincount(keys % size, minlength=size)
+
+
+def _idf_cache_file(dataset, vocab):
+    """
+    The idf cache file of a dataset, which is stored next to the data file.
+    Its name depends on the data file and on everything that affects the ids.
+    """
+    if not isinstance(dataset.input, str):
+        return None
+
+    stats = os.stat(dataset.input)
+    key = [dataset.input, stats.st_size, stats.st_mtime,
+           dataset.seq_len, dataset.oovs,
+           "\n".join(dataset.vocab.get_tokens()),
+           "\n".join(sorted(vocab, key=vocab.get))]
+    key = hashlib.md5(str(key).encode()).hexdigest()
+
+    return f"{dataset.input}.idf_{key}.npy"
+
+
+def compute_dataset_idf(dataset, vocab, workers=None, chunk_size=100000):
+    """
+    Compute the (smoothed) idf weights of the tokens in a dataset, as in
+    sklearn's TfidfVectorizer (`ln((1 + n) / (1 + df)) + 1`).
+    The document frequencies are counted over the (packed) token codes of
+    the dataset, in parallel over chunks of the data.
+    The results are cached to disk, next to the data file.
+
+    Args:
+        dataset (AEDataset): the dataset
+        vocab (dict): the token -> index mapping of the idf weights
+        workers (int): the number of processes. Defaults to the cpu count.
+        chunk_size (int): the number of samples in each chunk
+
+    Returns:
+        numpy.ndarray: the idf weight of each token
+
+    """
+    cache_file = _idf_cache_file(dataset, vocab)
+    if cache_file is not None and os.path.exists(cache_file):
+        print(f"Loading {cache_file} from cache!")
+        return numpy.load(cache_file)
+
+    v = dataset.vocab
+    data = dataset.data
+    if not isinstance(data, PackedCorpus):
+        data = PackedCorpus(data)
+
+    # map each token type of the corpus to the index of its idf weight,
+    # once. The tokens that are missing from the dataset's vocab are
+    # marked as unknown, as they are replaced by the OOV or UNK tokens.
+    size = max(vocab.values()) + 1
+    type_ids = numpy.array([vocab.get(t, -1) if t in v.tok2id else _UNKNOWN
+                            for t in data.types], dtype=numpy.int64)
+
+    def _index(token):
+        return vocab.get(token, -1) if token in v.tok2id else -1
+
+    specials = [i for i in (_index(v.SOS), _index(v.EOS)) if i >= 0]
+    slots = [_index(f"<oov-{i}>") for i in range(dataset.oovs)]
+    unk = _index(v.UNK)
+
+    chunks = []
+    for start in range(0, len(data), chunk_size):
+        end = min(start + chunk_size, len(data))
+        codes = data.codes[data.offsets[start]:data.offsets[end]]
+        chunks.append((codes, data.lengths[start:end], type_ids, specials,
+                       slots, unk, dataset.seq_len, size))
+
+    if len(chunks) > 1:
+        with Pool(workers) as pool:
+            counts = pool.map(_document_frequencies, chunks)
+    else:
+        counts = list(map(_document_frequencies, chunks))
+
+    df = numpy.sum(counts, axis=0)
+
+    idf = numpy.log((1 + len(data)) / (1 + df)) + 1
+
+    if cache_file is not None:
+        numpy.save(cache_file, idf)
 
-    tf = TfidfVectorizer(lowercase=False,
-                         tokenizer=identity_func,
-                         preprocessor=identity_func,
-                         use_idf=True,
-                         vocabulary=vocab)
-    tf.fit(my_data)
-    return tf.idf_
+    return idf
 
 
 def sample2text(word_ids, vocab):
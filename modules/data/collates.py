@@ -1,6 +1,85 @@
+import os
+
 import torch
 from torch.nn.utils.rnn import pad_sequence
 
+from modules.data.utils import swap_tokens, shuffle_tokens, word_dropout
+
+
+class TokenNoise:
+    """
+    Adds noise to a batch of padded sequences of ids, in the collate function
+    (after the OOV replacements), with vectorized operations:
+    local token swaps, token shuffling and word dropout (replacement by UNK).
+
+    The noise is reproducible. In the main process, it is sampled
+    from a generator seeded with `seed`. In each DataLoader worker,
+    it gets its own generator, seeded with the seed of the worker,
+    which torch derives from the seed of the main process
+    and changes in every epoch (unless the workers are persistent).
+    """
+
+    def __init__(self, swaps=0.0, shuffle=0.0, dropout=0.0, unk=None,
+                 seed=0):
+        """
+
+        Args:
+            swaps (float): the number of local swaps, relative to the length
+            shuffle (float): the number of transpositions,
+                relative to the length
+            dropout (float): the probability of replacing a token with UNK
+            unk (int): the id of the UNK token (required for dropout)
+            seed (int): the seed of the noise in the main process
+        """
+        self.swaps = swaps
+        self.shuffle = shuffle
+        self.dropout = dropout
+        self.unk = unk
+        self.seed = seed
+
+        if dropout > 0 and unk is None:
+            raise ValueError("The id of the UNK token is required!")
+
+        self._pid = os.getpid()
+        self._generator = None
+        self._generator_pid = None
+
+    def __getstate__(self):
+        # the generator is created again by each process
+        state = dict(self.__dict__)
+        state["_generator"] = None
+        state["_generator_pid"] = None
+        return state
+
+    def _get_generator(self):
+        pid = os.getpid()
+
+        if self._generator is None or self._generator_pid != pid:
+            self._generator = torch.Generator()
+            if pid == self._pid:
+                self._generator.manual_seed(self.seed)
+            else:
+                # in a worker, torch sets its own (per worker) seed
+                self._generator.manual_seed(torch.initial_seed())
+            self._generator_pid = pid
+
+        return self._generator
+
+    def enabled(self):
+        return self.swaps > 0 or self.shuffle > 0 or self.dropout > 0
+
+    def __call__(self, x, lengths):
+        generator = self._get_generator()
+
+        if self.swaps > 0:
+            x = swap_tokens(x, lengths, self.swaps, generator)
+        if self.shuffle > 0:
+            x = shuffle_tokens(x, lengths, self.shuffle, generator)
+        if self.dropout > 0:
+            x = word_dropout(x, lengths, self.dropout, self.unk, generator)
+
+        return x
+
 
 class SeqCollate:
     """
@@ -49,8 +128,14 @@ class CondLMCollate(SeqCollate):
 
 
 class Seq2SeqCollate(SeqCollate):
-    def __init__(self, *args):
+    def __init__(self, *args, noise=None):
+        """
+
+        Args:
+            noise (TokenNoise): the noise to add to the source sequences
+        """
         super().__init__(*args)
+        self.noise = noise
 
     def _collate(self, inp_src, out_src, inp_trg, out_trg, len_src, len_trg):
         inp_src = self.pad_samples(inp_src)
@@ -61,6 +146,9 @@ class Seq2SeqCollate(SeqCollate):
         len_src = torch.LongTensor(len_src)
         len_trg = torch.LongTensor(len_trg)
 
+        if self.noise is not None and self.noise.enabled():
+            inp_src = self.noise(inp_src, len_src)
+
         return inp_src, out_src, inp_trg, out_trg, len_src, len_trg
 
 
@@ -1,17 +1,16 @@
 import os
 from abc import ABC
 
-from nltk import word_tokenize
 from tabulate import tabulate
 from torch.utils.data import Dataset
 
 from modules.data.utils import vectorize, read_corpus, read_corpus_subw, \
-    unks_per_sample, token_swaps
+    corpus_stats
 
 
 class BaseLMDataset(Dataset, ABC):
     def __init__(self, input, preprocess=None,
-                 vocab=None, vocab_size=None,
+                 vocab=None, vocab_size=None, vocab_max_types=None,
                  subword=False, subword_path=None, verbose=True, **kwargs):
         """
         Base Dataset for Language Modeling.
@@ -23,6 +22,8 @@ class BaseLMDataset(Dataset, ABC):
             vocab (Vocab): a vocab instance. If None, then build a new one
                 from the Datasets data.
             vocab_size(int): if given, then trim the vocab to the given number.
+            vocab_max_types(int): if given, then estimate the frequencies
+                of the tokens in bounded memory (see SpaceSaving).
             subword(bool): whether the dataset will be
                 tokenized using subword units, using the SentencePiece package.
             subword(SentencePieceProcessor): path to the sentencepiece model
@@ -31,6 +32,8 @@ class BaseLMDataset(Dataset, ABC):
         self.input = input
         self.subword = subword
         self.subword_path = subword_path
+        self.oovs = kwargs.get("oovs", 0)
+        self._stats = None
 
         if preprocess is not None:
             self.preprocess = preprocess
@@ -39,7 +42,10 @@ class BaseLMDataset(Dataset, ABC):
         if self.subword:
             self.vocab, self.data = read_corpus_subw(input, subword_path)
         else:
-            self.vocab, self.data = read_corpus(input, self.preprocess)
+            # the tokens are counted, only if a new vocab has to be built
+            self.vocab, self.data = read_corpus(input, self.preprocess,
+                                                count=vocab is None,
+                                                max_types=vocab_max_types)
 
         if vocab is not None:
             self.vocab = vocab
@@ -50,22 +56,33 @@ class BaseLMDataset(Dataset, ABC):
             print(self)
             print()
 
+    def stats(self):
+        """
+        The statistics of the dataset (see corpus_stats).
+        They are computed once and recomputed only if the data
+        or the size of the vocab change.
+        """
+        key = (len(self.data), len(self.vocab))
+
+        if self._stats is None or self._stats[0] != key:
+            stats = corpus_stats(self.data, self.vocab, self.oovs,
+                                 getattr(self, "seq_len", None))
+            self._stats = key, stats
+
+        return self._stats[1]
+
     def __str__(self):
+        stats = self.stats()
 
         props = []
         if isinstance(self.input, str):
             props.append(("source", os.path.basename(self.input)))
 
-        _covarage = unks_per_sample(self.vocab.tok2id.keys(), self.data)
-        _covarage = str(_covarage.round(4)) + " %"
-
-        try:
-            props.append(("size", len(self)))
-        except:
-            pass
-        props.append(("vocab size", len(self.vocab)))
-        props.append(("unique tokens", len(self.vocab.vocab)))
-        props.append(("UNK per sample", _covarage))
+        props.append(("size", stats["size"]))
+        props.append(("vocab size", stats["vocab size"]))
+        props.append(("unique tokens", stats["unique tokens"]))
+        props.append(("UNK rate", f"{stats['UNK rate']:.4f} %"))
+        props.append(("UNK per sample", f"{stats['UNK per sample']:.4f} %"))
         props.append(("subword", self.subword))
 
         if hasattr(self, 'seq_len'):
@@ -82,6 +99,9 @@ class BaseLMDataset(Dataset, ABC):
 
     @staticmethod
     def preprocess(text, lower=True):
+        # imported here, in order to avoid loading nltk on every import
+        from nltk import word_tokenize
+
         if lower:
             text = text.lower()
         # return text.split()
@@ -142,7 +162,6 @@ class AEDataset(BaseLMDataset):
         self.seq_len = seq_len
         self.oovs = kwargs.get("oovs", 0)
         self.return_oov = kwargs.get("return_oov", False)
-        self.swaps = kwargs.get("swaps", 0.0)
 
         for i in range(self.oovs):
             self.vocab.add_token(f"<oov-{i}>")
@@ -176,9 +195,6 @@ class AEDataset(BaseLMDataset):
         else:
             raise NotImplementedError
 
-        # add noise in the form of token swaps ! after the OOV replacements
-        inp_x = token_swaps(inp_x, self.swaps)
-
         sample = inp_x, out_x, inp_xhat, out_xhat, len(inp_x), len(inp_xhat)
 
         if self.return_oov:
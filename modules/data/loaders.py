@@ -0,0 +1,244 @@
+import inspect
+import threading
+from queue import Queue, Full
+
+import numpy
+import torch
+from torch.utils.data import DataLoader
+
+
+class _Stop:
+    pass
+
+
+class _Error:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class DevicePrefetcher:
+    """
+    Wraps a DataLoader (or any iterable of batches) and moves its batches
+    to the given device ahead of time, so that the data preparation
+    overlaps with the computations of the previous step.
+
+    A background thread keeps up to `depth` batches ready (in pinned
+    memory, for CUDA devices), and the copy of the next batch to the device
+    is issued (non-blocking, on a separate CUDA stream) before the current
+    batch is returned.
+    Tensors (also within lists and tuples) are moved to the device and
+    everything else (e.g. the OOV maps of Seq2SeqOOVCollate) is passed
+    through as it is.
+    """
+
+    def __init__(self, loader, device, depth=2, pin_memory=None):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+
+        cuda = self.device.type == "cuda"
+        self.pin_memory = cuda if pin_memory is None else pin_memory
+        self.stream = torch.cuda.Stream(self.device) if cuda else None
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _pin(self, x):
+        if torch.is_tensor(x):
+            return x.pin_memory()
+        elif isinstance(x, (list, tuple)):
+            return type(x)(self._pin(y) for y in x)
+        return x
+
+    def _to_device(self, x):
+        if torch.is_tensor(x):
+            return x.to(self.device, non_blocking=True)
+        elif isinstance(x, (list, tuple)):
+            return type(x)(self._to_device(y) for y in x)
+        return x
+
+    def _record_stream(self, x):
+        # the memory of the batch must not be reused, before the
+        # computations on the current stream are finished
+        if torch.is_tensor(x):
+            x.record_stream(torch.cuda.current_stream(self.device))
+        elif isinstance(x, (list, tuple)):
+            for y in x:
+                self._record_stream(y)
+
+    def _worker(self, queue, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        try:
+            for batch in self.loader:
+                if self.pin_memory:
+                    batch = self._pin(batch)
+                if not put(batch):
+                    return
+        except Exception as e:
+            put(_Error(e))
+            return
+
+        put(_Stop())
+
+    def _next(self, queue):
+        item = queue.get()
+
+        if isinstance(item, _Error):
+            raise item.exception
+        if isinstance(item, _Stop):
+            return item
+
+        if self.stream is not None:
+            with torch.cuda.stream(self.stream):
+                return self._to_device(item)
+
+        return self._to_device(item)
+
+    def __iter__(self):
+        queue = Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._worker, args=(queue, stop),
+                                  daemon=True)
+        thread.start()
+
+        try:
+            batch = self._next(queue)
+            while not isinstance(batch, _Stop):
+                if self.stream is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_stream(self.stream)
+                    self._record_stream(batch)
+
+                # issue the copy of the next batch, before returning this one
+                next_batch = self._next(queue)
+                yield batch
+                batch = next_batch
+        finally:
+            stop.set()
+            thread.join()
+
+
+class MultiLoader:
+    """
+    Mixes the batches of multiple loaders (e.g., of different corpora).
+
+    In each step, the batch is drawn from a loader, which is sampled
+    with probability proportional to weight^(1 / temperature).
+    By default, the weights are the number of batches of each loader,
+    so with temperature=1 each batch of every loader is drawn once per epoch
+    (in expectation), and higher temperatures upsample the smaller corpora.
+
+    The iterators of the loaders persist across the epochs (of the mixer)
+    and each one is restarted only when it is exhausted.
+    The progress over each loader is reported by state_dict (e.g., to be
+    saved in the checkpoints). It is not a resumable position, as the
+    loaders do not iterate in a reproducible order.
+    """
+
+    def __init__(self, loaders, weights=None, temperature=1.0, steps=None,
+                 seed=0):
+        """
+
+        Args:
+            loaders (list): the loaders to mix. The first one is the primary,
+                i.e., its dataset (and vocab) is exposed as `dataset`
+            weights (list): the (relative) weight of each loader
+            temperature (float): the temperature of the sampling distribution
+            steps (int): the number of batches per epoch.
+                Default: the total number of batches of the loaders
+            seed (int): the seed of the sampling of the loaders
+        """
+        self.loaders = loaders
+
+        if weights is None:
+            weights = [len(x) for x in loaders]
+
+        p = numpy.array(weights, dtype=numpy.float64) ** (1 / temperature)
+        self.probabilities = p / p.sum()
+
+        if steps is None:
+            steps = sum(len(x) for x in loaders)
+        self.steps = steps
+
+        self.rng = numpy.random.RandomState(seed)
+
+        self._iterators = [None] * len(loaders)
+        self.epochs = [0] * len(loaders)
+        self.positions = [0] * len(loaders)
+
+    @property
+    def dataset(self):
+        return self.loaders[0].dataset
+
+    @property
+    def datasets(self):
+        return [x.dataset for x in self.loaders]
+
+    @property
+    def n_samples(self):
+        """
+        The expected number of samples in an epoch.
+        """
+        return int(sum(p * self.steps * len(x.dataset) / len(x)
+                       for p, x in zip(self.probabilities, self.loaders)))
+
+    def __len__(self):
+        return self.steps
+
+    def _next(self, i):
+        if self._iterators[i] is None:
+            self._iterators[i] = iter(self.loaders[i])
+
+        try:
+            batch = next(self._iterators[i])
+        except StopIteration:
+            self.epochs[i] += 1
+            self.positions[i] = 0
+            self._iterators[i] = iter(self.loaders[i])
+            batch = next(self._iterators[i])
+
+        self.positions[i] += 1
+        return batch
+
+    def __iter__(self):
+        ids = numpy.arange(len(self.loaders))
+        for _ in range(self.steps):
+            yield self._next(self.rng.choice(ids, p=self.probabilities))
+
+    def state_dict(self):
+        """
+        The progress of the mixer: the number of epochs over each loader
+        and the number of batches drawn from it in the current epoch.
+        Note that if the mixer is wrapped by a DevicePrefetcher,
+        the counts include the prefetched batches.
+        """
+        return {"epochs": list(self.epochs),
+                "positions": list(self.positions)}
+
+
+def worker_kwargs(num_workers):
+    """
+    The DataLoader arguments of its worker processes.
+    The workers (and their copy of the dataset) are kept alive across
+    the epochs (persistent_workers), if it is supported by torch,
+    instead of being re-created in every epoch.
+    """
+    kwargs = {"num_workers": num_workers}
+
+    params = inspect.signature(DataLoader.__init__).parameters
+    if num_workers > 0 and "persistent_workers" in params:
+        kwargs["persistent_workers"] = True
+
+    return kwargs
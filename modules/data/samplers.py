@@ -21,21 +21,33 @@ class SortedSampler(Sampler):
         self.lengths = lengths
         self.desc = descending
 
-    def __iter__(self):
-
+        self.order = numpy.array(lengths).argsort()
         if self.desc:
-            return iter(numpy.flip(numpy.array(self.lengths).argsort(), 0))
-        else:
-            return iter(numpy.array(self.lengths).argsort())
+            self.order = numpy.flip(self.order, 0)
+
+    def __iter__(self):
+        return iter(self.order)
 
     def __len__(self):
         return len(self.lengths)
 
+    def unsort(self, items):
+        """
+        Revert a list of items (e.g. predictions), which are in the order
+        of the sampler, to the original order of the dataset.
+        """
+        restored = [None] * len(items)
+        for i, item in zip(self.order, items):
+            restored[i] = item
+        return restored
+
 
 class BucketBatchSampler(Sampler):
     """
     Defines a strategy for drawing batches of samples from the dataset,
     in ascending or descending order, based in the sample lengths.
+    The samples within each batch are in descending order of length,
+    so that they can be packed without being sorted.
     """
 
     def __init__(self, lengths, batch_size,
@@ -47,6 +59,8 @@ class BucketBatchSampler(Sampler):
         else:
             self.batches = numpy.array_split(sorted_indices, num_sections)
 
+        self.batches = [numpy.flip(b, 0) for b in self.batches]
+
         if reverse:
             self.batches = list(reversed(self.batches))
 
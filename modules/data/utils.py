@@ -4,12 +4,11 @@ import hashlib
 import inspect
 import os
 import pickle
-import random
+from array import array
 from subprocess import check_output
 
 import numpy
-import sentencepiece as spm
-from matplotlib import pyplot as plt
+import torch
 from tqdm import tqdm
 
 from modules.data.vocab import Vocab
@@ -108,15 +107,119 @@ def iterate_data(data):
             yield x
 
 
+class PackedCorpus:
+    """
+    A (read-only) list of tokenized sentences, stored compactly.
+
+    Each unique token (type) is stored once, in a buffer of UTF-8 bytes
+    with the offsets of each type, and the sentences are stored as a flat
+    numpy array of token codes, with the offsets of each sentence.
+    This is much smaller than lists of strings and, since the corpus
+    consists only of numpy arrays (no Python objects), the DataLoader
+    workers can share the memory of the (forked) dataset, instead of
+    gradually copying it. The strings are created only on access.
+
+    Indexing returns the tokens of a sentence and slicing a PackedCorpus.
+    """
+
+    def __init__(self, sentences=()):
+        types = {}
+        codes = array("i")
+        lengths = array("q")
+
+        for tokens in sentences:
+            codes.extend(types.setdefault(t, len(types)) for t in tokens)
+            lengths.append(len(tokens))
+
+        encoded = [t.encode("utf-8") for t in types]
+        self.type_bytes = numpy.frombuffer(b"".join(encoded),
+                                           dtype=numpy.uint8)
+        self.type_offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(t) for t in encoded], out=self.type_offsets[1:])
+
+        self.codes = numpy.frombuffer(codes, dtype=numpy.int32)
+        self.offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.frombuffer(lengths, dtype=numpy.int64),
+                     out=self.offsets[1:])
+
+    @property
+    def n_types(self):
+        return len(self.type_offsets) - 1
+
+    @property
+    def types(self):
+        """
+        The unique tokens of the corpus (a list of str), indexed by code.
+        """
+        return self._decode(range(self.n_types))
+
+    @property
+    def lengths(self):
+        return numpy.diff(self.offsets)
+
+    def _decode(self, codes):
+        codes = numpy.asarray(codes, dtype=numpy.int64)
+        buffer = memoryview(self.type_bytes)
+        starts = self.type_offsets[codes].tolist()
+        ends = self.type_offsets[codes + 1].tolist()
+        return [str(buffer[s:e], "utf-8") for s, e in zip(starts, ends)]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._subset(range(len(self))[index])
+
+        if index < 0:
+            index += len(self)
+
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self._decode(self.codes[start:end])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def _subset(self, indices):
+        corpus = PackedCorpus()
+        corpus.type_bytes = self.type_bytes
+        corpus.type_offsets = self.type_offsets
+        corpus.codes = numpy.concatenate(
+            [self.codes[self.offsets[i]:self.offsets[i + 1]]
+             for i in indices] or [self.codes[:0]])
+        corpus.offsets = numpy.zeros(len(indices) + 1, dtype=numpy.int64)
+        numpy.cumsum(self.lengths[list(indices)], out=corpus.offsets[1:])
+        return corpus
+
+
 # @disk_memoize
-def read_corpus(file, tokenize):
-    _vocab = Vocab()
+def read_corpus(file, tokenize, count=True, max_types=None):
+    """
+    Tokenize a corpus and count the frequencies of its tokens.
 
-    _data = []
-    for line in iterate_data(file):
-        tokens = tokenize(line)
-        _vocab.read_sequence(tokens)
-        _data.append(tokens)
+    Args:
+        file (str, list): the path to the data file, or a list of samples
+        tokenize (callable): the tokenizer of each sample
+        count (bool): count the tokens. Disable it, if the corpus will use
+            an existing vocab, in which case the returned vocab is empty.
+        max_types (int): estimate the frequencies of the tokens,
+            tracking at most (2x) max_types tokens (see SpaceSaving).
+            If None, then count all the tokens exactly.
+
+    Returns:
+        the Vocab (with the token frequencies) and the PackedCorpus
+    """
+    _vocab = Vocab(max_types=max_types)
+
+    def _sentences():
+        for line in iterate_data(file):
+            tokens = tokenize(line)
+            if count:
+                _vocab.read_sequence(tokens)
+            yield tokens
+
+    _data = PackedCorpus(_sentences())
 
     return _vocab, _data
 
@@ -134,6 +237,8 @@ def build_vocab_from_file(file, tokenize):
 
 # @disk_memoize
 def read_corpus_subw(file, subword_path):
+    import sentencepiece as spm
+
     subword = spm.SentencePieceProcessor()
     subword.Load(subword_path + ".model")
 
@@ -147,10 +252,12 @@ def read_corpus_subw(file, subword_path):
 
     vocab.subword = subword
 
-    return vocab, _data
+    return vocab, PackedCorpus(_data)
 
 
 def hist_dataset(data, seq_len):
+    from matplotlib import pyplot as plt
+
     lengths = [len(x) for x in data]
     plt.hist(lengths, density=1, bins=20)
     plt.axvline(seq_len, color='k', linestyle='dashed', linewidth=1)
@@ -165,38 +272,169 @@ def covarage(vocab, top_n):
 
 
 def unks_per_sample(keys, data):
+    """
+    The mean ratio (%) of the unique unknown tokens of each sample
+    to its length.
+    """
     known = set(keys)
-    _coverage = [len(set(x) - known) / len(x) for x in data]
-    return numpy.mean(_coverage) * 100
 
+    if not isinstance(data, PackedCorpus):
+        _coverage = [len(set(x) - known) / len(x) for x in data]
+        return numpy.mean(_coverage) * 100
 
-def token_shuffle(words, factor):
-    words = list(words)
-    length = len(words)
-    shuffles = int(length * factor)
+    _, unks = _packed_unknowns(data, known)
+    return numpy.mean(unks / data.lengths) * 100
 
-    if len(words) < 5:
-        return words
 
-    for i in range(shuffles):
-        i, j = tuple(int(random.random() * length) for i in range(2))
-        words[i], words[j] = words[j], words[i]
-    return words
+def _packed_unknowns(data, known):
+    """
+    Find the unknown tokens of a PackedCorpus, checking each type once.
 
+    Returns:
+        the mask of the unknown tokens (over the codes of the corpus)
+        and the number of the unique unknown tokens of each sample
+    """
+    unknown = numpy.array([t not in known for t in data.types], dtype=bool)
+    mask = unknown[data.codes]
 
-def token_swaps(words, factor):
-    if not factor > 0:
-        return words
+    # count the unique unknown (sample, type) pairs
+    n_types = max(data.n_types, 1)
+    samples = numpy.repeat(numpy.arange(len(data)), data.lengths)
+    pairs = numpy.unique(samples[mask] * n_types + data.codes[mask])
+    unks = numpy.bincount(pairs // n_types, minlength=len(data))
 
-    words = list(words)
-    length = len(words)
-    shuffles = int(length * factor)
+    return mask, unks
 
-    if len(words) < 4:
-        return words
 
-    for it in range(shuffles):
-        j = random.randint(0, length - 2)
-        words[j], words[j + 1] = words[j + 1], words[j]
+def corpus_stats(data, vocab, oovs=0, seq_len=None,
+                 top_n=(1000, 5000, 10000, 20000, 50000), bins=10):
+    """
+    Compute the statistics of a (packed) corpus, with vectorized operations
+    over the codes of its tokens.
 
-    return words
+    Args:
+        data (PackedCorpus): the tokenized corpus
+        vocab (Vocab): the vocabulary, which defines the unknown tokens
+        oovs (int): the number of the special OOV tokens
+        seq_len (int): the maximum length of the samples
+        top_n (tuple): the vocabulary sizes of the coverage statistics
+        bins (int): the number of bins of the histogram of the lengths
+
+    Returns:
+        dict: the statistics of the corpus
+    """
+    if not isinstance(data, PackedCorpus):
+        data = PackedCorpus(data)
+
+    lengths = data.lengths
+    n_types = data.n_types
+
+    # the unique unknown tokens of each sample take the OOV slots
+    unknown, unks = _packed_unknowns(data, vocab.tok2id)
+
+    # the coverage of the tokens by the N most frequent types of the corpus
+    freqs = numpy.sort(numpy.bincount(data.codes, minlength=n_types))[::-1]
+    cumulative = numpy.cumsum(freqs) / max(len(data.codes), 1)
+    coverage = {n: float(cumulative[min(n, n_types) - 1])
+                for n in top_n if n_types > 0}
+
+    hist, edges = numpy.histogram(lengths, bins=bins)
+
+    stats = {
+        "size": len(data),
+        "tokens": len(data.codes),
+        "unique tokens": n_types,
+        "vocab size": len(vocab),
+        "lengths": {
+            "mean": float(lengths.mean()) if len(data) else 0.,
+            "max": int(lengths.max()) if len(data) else 0,
+            "histogram": (hist.tolist(), edges.tolist()),
+        },
+        "UNK rate": float(unknown.mean() * 100) if len(unknown) else 0.,
+        "UNK per sample": float(numpy.mean(unks / numpy.maximum(lengths, 1))
+                                * 100) if len(data) else 0.,
+        "coverage": coverage,
+    }
+
+    if oovs > 0:
+        stats["OOV slots"] = {
+            "mean": float(numpy.minimum(unks, oovs).mean()),
+            # % of the samples with more unknown tokens than OOV slots
+            "overflow": float((unks > oovs).mean() * 100),
+        }
+
+    if seq_len is not None:
+        stats["truncated"] = float((lengths > seq_len).mean() * 100)
+
+    return stats
+
+
+def _noise_counts(lengths, factor, min_length):
+    # int(length * factor) operations per sample, for the long enough samples
+    counts = (lengths.double() * factor).long()
+    counts[lengths < min_length] = 0
+    return counts
+
+
+def swap_tokens(x, lengths, factor, generator=None, min_length=4):
+    """
+    Local (adjacent) token swaps, applied in place to a batch
+    of padded sequences of ids. Each sample gets int(length * factor)
+    swaps, in uniformly sampled positions, which are applied sequentially,
+    so a token can move by more than one position.
+
+    Args:
+        x (LongTensor): the (batch first) padded sequences
+        lengths (LongTensor): the lengths of the sequences
+        factor (float): the number of swaps, relative to the length
+        generator (torch.Generator): the RNG
+        min_length (int): the samples shorter than that are not changed
+
+    Returns:
+        the noisy sequences
+    """
+    counts = _noise_counts(lengths, factor, min_length)
+    rows = torch.arange(x.size(0))
+    span = (lengths - 1).clamp(min=1).double()
+
+    for k in range(int(counts.max()) if len(counts) > 0 else 0):
+        active = counts > k
+        j = (torch.rand(x.size(0), generator=generator,
+                        dtype=torch.double) * span).long()
+        r, j = rows[active], j[active]
+        x[r, j], x[r, j + 1] = x[r, j + 1], x[r, j]
+
+    return x
+
+
+def shuffle_tokens(x, lengths, factor, generator=None, min_length=5):
+    """
+    Token shuffling, applied in place to a batch of padded sequences of ids.
+    Each sample gets int(length * factor) transpositions of
+    two (uniformly sampled) tokens.
+    See swap_tokens for the arguments.
+    """
+    counts = _noise_counts(lengths, factor, min_length)
+    rows = torch.arange(x.size(0))
+    span = lengths.double()
+
+    for k in range(int(counts.max()) if len(counts) > 0 else 0):
+        active = counts > k
+        i, j = (torch.rand(2, x.size(0), generator=generator,
+                           dtype=torch.double) * span).long()
+        r, i, j = rows[active], i[active], j[active]
+        x[r, i], x[r, j] = x[r, j], x[r, i]
+
+    return x
+
+
+def word_dropout(x, lengths, p, unk, generator=None):
+    """
+    Word dropout, applied in place to a batch of padded sequences of ids.
+    Each token is replaced by the UNK token with probability p.
+    """
+    positions = torch.arange(x.size(1)).unsqueeze(0)
+    mask = torch.rand(x.size(), generator=generator,
+                      dtype=torch.double) < p
+    x[mask & (positions < lengths.unsqueeze(1))] = unk
+    return x
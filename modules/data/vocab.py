@@ -1,27 +1,91 @@
+import heapq
+import itertools
 from collections.__init__ import Counter
+from operator import itemgetter
 
 import numpy
-from gensim.models import FastText
-from tqdm import tqdm
 
-from utils.load_embeddings import load_word_vectors
+from sys_config import RANDOM_SEED
+from utils.load_embeddings import load_filtered_word_vectors, \
+    fasttext_vectors
+
+
+class SpaceSaving(object):
+    """
+    Approximate counter of the most frequent tokens of a stream,
+    in bounded memory (Space-Saving, Metwally et al. 2005).
+
+    At most 2 * `capacity` tokens are tracked. When the limit is reached,
+    only the `capacity` most frequent ones are kept, and the tokens that
+    appear afterwards start counting from the largest evicted count
+    (`self.floor`), which is an upper bound of their count so far.
+    So the counts may be overestimated by at most `self.errors[token]`,
+    and every token, whose frequency exceeds `self.floor`, is tracked.
+
+    It implements the parts of the Counter interface that are used by
+    the Vocab (update, most_common and len).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = dict()
+        self.errors = dict()
+        self.floor = 0
+
+    def update(self, tokens):
+        counts = self.counts
+        for token in tokens:
+            if token not in counts:
+                counts[token] = self.floor
+                self.errors[token] = self.floor
+            counts[token] += 1
+
+        if len(counts) > 2 * self.capacity:
+            self._evict()
+
+    def _evict(self):
+        top = heapq.nlargest(self.capacity + 1, self.counts.items(),
+                             key=itemgetter(1))
+        self.floor = max(self.floor, top[-1][1])
+        self.counts = dict(top[:-1])
+        self.errors = {t: self.errors[t] for t in self.counts}
+
+    def most_common(self, n=None):
+        if n is None:
+            return sorted(self.counts.items(), key=itemgetter(1),
+                          reverse=True)
+        return heapq.nlargest(n, self.counts.items(), key=itemgetter(1))
+
+    def __len__(self):
+        return len(self.counts)
 
 
 class Vocab(object):
     """
     The Vocab Class, holds the vocabulary of a corpus and
     mappings from tokens to indices and vice versa.
+
+    When pickled (e.g., in a checkpoint), only the id-ordered tokens are
+    stored, so the token frequencies (`self.vocab`) are lost and
+    a restored Vocab cannot be re-trimmed.
+
+    With `max_types`, the token frequencies are estimated in bounded memory
+    (see SpaceSaving), instead of counting all the unique tokens of the
+    corpus. It should be a few times larger than the size of the vocabulary.
     """
 
     def __init__(self, pad="<pad>", sos="<sos>", eos="<eos>", unk="<unk>",
-                 oovs=0):
+                 oovs=0, max_types=None):
         self.PAD = pad
         self.SOS = sos
         self.EOS = eos
         self.UNK = unk
         self.oovs = oovs
 
-        self.vocab = Counter()
+        if max_types:
+            self.vocab = SpaceSaving(max_types)
+        else:
+            self.vocab = Counter()
 
         self.tok2id = dict()
         self.id2tok = dict()
@@ -30,6 +94,30 @@ class Vocab(object):
 
         self.subword = None
 
+        # id -> token lookup table (numpy array), built on demand
+        self._tokens = None
+
+    def __getstate__(self):
+        state = {k: v for k, v in self.__dict__.items()
+                 if k not in ["vocab", "tok2id", "id2tok", "_tokens"]}
+        state["tokens"] = self.get_tokens()
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        tokens = state.pop("tokens", None)
+
+        self.__dict__.update(state)
+        self._tokens = None
+
+        # the pickles of older versions contain the full state
+        if tokens is not None:
+            self.vocab = Counter()
+            self.tok2id = dict()
+            self.id2tok = dict()
+            for token in tokens:
+                self.add_token(token)
+
     def read_sequence(self, tokens):
         self.vocab.update(tokens)
 
@@ -38,7 +126,7 @@ class Vocab(object):
         self.id2tok = dict()
         self.build(size)
 
-    def read_embeddings(self, file, dim):
+    def read_embeddings(self, file, dim, seed=RANDOM_SEED):
         """
         Create an Embeddings Matrix, in which each row corresponds to
         the word vector from the pretrained word embeddings.
@@ -48,45 +136,40 @@ class Vocab(object):
         Args:
             file:
             dim:
+            seed: the seed of the RNG, used for sampling the missing embeddings
 
         Returns:
 
         """
-        word2idx, idx2word, embeddings = load_word_vectors(file, dim)
+        tokens = self.get_tokens()
+        vectors, found, (mu, sigma) = load_filtered_word_vectors(file, dim,
+                                                                 tokens)
+
+        filtered_embeddings = vectors.astype(numpy.float64)
 
-        mu = embeddings.mean(axis=0)
-        sigma = embeddings.std(axis=0)
+        missing = ~found
+        if self.UNK in self.tok2id:
+            missing[self.tok2id[self.UNK]] = True
+        missing = numpy.flatnonzero(missing)
 
-        filtered_embeddings = numpy.zeros((len(self), embeddings.shape[1]))
+        # todo: smart sampling per dim distribution
+        rng = numpy.random.RandomState(seed)
+        filtered_embeddings[missing] = rng.normal(mu, sigma / 4,
+                                                  (len(missing), dim))
 
         mask = numpy.zeros(len(self))
-        missing = []
-
-        for token_id, token in tqdm(self.id2tok.items(),
-                                    desc="Reading embeddings...",
-                                    total=len(self.id2tok.items())):
-            if token not in word2idx or token == "<unk>":
-                # todo: smart sampling per dim distribution
-                # sample = numpy.random.uniform(low=-0.5, high=0.5,
-                #                               size=embeddings.shape[1])
-                sample = numpy.random.normal(mu, sigma / 4)
-                filtered_embeddings[token_id] = sample
-
-                mask[token_id] = 1
-                missing.append(token_id)
-            else:
-                filtered_embeddings[token_id] = embeddings[word2idx[token]]
+        mask[missing] = 1
 
         print(f"Missing tokens from the pretrained embeddings: {len(missing)}")
 
-        return filtered_embeddings, mask, missing
+        return filtered_embeddings, mask, missing.tolist()
 
     def read_fasttext(self, file):
         """
         Create an Embeddings Matrix, in which each row corresponds to
         the word vector from the pretrained word embeddings.
         If a word is missing then obtain a representation on-the-fly
-        using fasttext.
+        using fasttext (from its character n-grams).
 
         Args:
             file:
@@ -95,18 +178,16 @@ class Vocab(object):
         Returns:
 
         """
-        model = FastText.load_fasttext_format(file)
+        # imported here, in order to avoid loading gensim on every import
+        from gensim.models import FastText
 
-        embeddings = numpy.zeros((len(self), model.vector_size))
+        model = FastText.load_fasttext_format(file)
 
-        missing = []
+        tokens = self.get_tokens()
+        vectors, found = fasttext_vectors(model.wv, tokens)
 
-        for token_id, token in tqdm(self.id2tok.items(),
-                                    desc="Reading embeddings...",
-                                    total=len(self.id2tok.items())):
-            if token not in model.wv.vocab:
-                missing.append(token)
-            embeddings[token_id] = model[token]
+        embeddings = vectors.astype(numpy.float64)
+        missing = [t for t, f in zip(tokens, found) if not f]
 
         print(f"Missing tokens from the pretrained embeddings: {len(missing)}")
 
@@ -119,6 +200,7 @@ class Vocab(object):
             self.tok2id[token] = index
             self.id2tok[index] = token
             self.size = len(self)
+            self._tokens = None
 
     def __add_special_tokens(self):
         self.add_token(self.PAD)
@@ -138,6 +220,30 @@ class Vocab(object):
         with open(file, "w") as f:
             f.write("\n".join(self.tok2id.keys()))
 
+    def to_dict(self):
+        """
+        A compact, json-serializable representation of the vocabulary,
+        which contains only the special tokens and the id-ordered tokens.
+        """
+        return {
+            "pad": self.PAD,
+            "sos": self.SOS,
+            "eos": self.EOS,
+            "unk": self.UNK,
+            "oovs": self.oovs,
+            "tokens": self.get_tokens(),
+        }
+
+    def from_dict(self, state):
+        self.PAD = state["pad"]
+        self.SOS = state["sos"]
+        self.EOS = state["eos"]
+        self.UNK = state["unk"]
+        self.oovs = state["oovs"]
+
+        for token in state["tokens"]:
+            self.add_token(token)
+
     def is_corrupt(self):
         return len([tok for tok, index in self.tok2id.items()
                     if self.id2tok[index] != tok]) > 0
@@ -145,6 +251,103 @@ class Vocab(object):
     def get_tokens(self):
         return [self.id2tok[key] for key in sorted(self.id2tok.keys())]
 
+    def token_array(self):
+        """
+        The id -> token lookup table, as a numpy (object) array.
+        """
+        if self._tokens is None:
+            self._tokens = numpy.array(self.get_tokens(), dtype=object)
+        return self._tokens
+
+    def encode(self, sentences, oovs=0):
+        """
+        Convert a batch of tokenized sentences to ids. It produces the same
+        results as calling `vectorize` on each sentence, but the lookups and
+        the assignment of the OOV slots are performed in bulk.
+
+        Args:
+            sentences (list): list of lists of tokens
+            oovs (int): the number of special OOV tokens
+
+        Returns: list of (numpy) arrays of ids and, if oovs > 0,
+            the list of the OOV maps of each sentence
+
+        """
+        lengths = numpy.fromiter(map(len, sentences), dtype=numpy.int64,
+                                 count=len(sentences))
+        tokens = list(itertools.chain.from_iterable(sentences))
+        ids = numpy.fromiter(map(self.tok2id.get, tokens,
+                                 itertools.repeat(-1, len(tokens))),
+                             dtype=numpy.int64, count=len(tokens))
+
+        oov_maps = [dict() for _ in sentences]
+        unknown = numpy.flatnonzero(ids < 0)
+
+        if len(unknown) > 0 and oovs > 0:
+            codes = dict()
+            unk_codes = numpy.array([codes.setdefault(tokens[i], len(codes))
+                                     for i in unknown], dtype=numpy.int64)
+            unk_sents = numpy.repeat(numpy.arange(len(sentences)),
+                                     lengths)[unknown]
+
+            # each unique (sentence, token) pair gets an OOV slot, which is
+            # the rank of its first appearance within the sentence
+            keys = unk_sents * len(codes) + unk_codes
+            uniq, first, inverse = numpy.unique(keys, return_index=True,
+                                                return_inverse=True)
+            order = numpy.argsort(first, kind="mergesort")
+            order_sents = uniq[order] // len(codes)
+            rank = numpy.empty_like(order)
+            rank[order] = (numpy.arange(len(order))
+                           - numpy.searchsorted(order_sents, order_sents))
+
+            # the OOV tokens that exceed the limit, get the generic UNK token
+            slot_ids = [self.tok2id[f"<oov-{i}>"] for i in range(oovs)]
+            slot_ids = numpy.array(slot_ids + [self.tok2id[self.UNK]])
+            ids[unknown] = slot_ids[numpy.minimum(rank[inverse], oovs)]
+
+            for u in order[rank[order] < oovs]:
+                token = tokens[unknown[first[u]]]
+                oov_maps[uniq[u] // len(codes)][f"<oov-{rank[u]}>"] = token
+
+        elif len(unknown) > 0:
+            ids[unknown] = self.tok2id[self.UNK]
+
+        if len(sentences) > 0:
+            ids = numpy.split(ids, numpy.cumsum(lengths)[:-1])
+        else:
+            ids = []
+
+        if oovs > 0:
+            return ids, oov_maps
+        else:
+            return ids
+
+    def decode(self, ids, eos=None):
+        """
+        Convert a batch of ids back to tokens.
+
+        Args:
+            ids (array-like): 2D matrix (batch x length) of ids
+            eos (int): if given, strip each row at its first `eos` id
+
+        Returns: list of lists of tokens
+
+        """
+        ids = numpy.asarray(ids)
+        lengths = numpy.full(len(ids), ids.shape[-1])
+
+        if eos is not None:
+            is_eos = ids == eos
+            lengths = numpy.where(is_eos.any(-1), is_eos.argmax(-1), lengths)
+
+        table = self.token_array()
+        valid = (ids >= 0) & (ids < len(table))
+        tokens = table[numpy.where(valid, ids, 0)]
+        tokens[~valid] = self.UNK
+
+        return [row[:l].tolist() for row, l in zip(tokens, lengths)]
+
     def build(self, size=None):
         self.__add_special_tokens()
 
@@ -1,5 +1,4 @@
 import torch
-from numpy import mean
 from torch.nn import functional as F
 from torch.nn.functional import _gumbel_softmax_sample
 
@@ -53,6 +52,151 @@ def expected_vecs(dists, vecs):
     return embs
 
 
+class TopkExpectation(torch.autograd.Function):
+    """
+    Approximate the expectation of the vectors, under a distribution,
+    using only its k most probable entries. This is exact for one-hot
+    distributions (e.g. Straight-Through) with k=1.
+
+    The forward pass costs O(k*E), instead of O(V*E) per distribution.
+    The gradient wrt the distribution is the one of the dense expectation
+    (straight-through), so that it reaches all the entries of the
+    distribution, whereas only the k selected vectors get gradients.
+    """
+
+    @staticmethod
+    def forward(ctx, dists, vecs, k):
+        values, indices = dists.topk(k, dim=-1)
+        embs = (values.unsqueeze(-1) * vecs[indices]).sum(-2)
+
+        ctx.save_for_backward(values, indices, vecs)
+
+        return embs
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        values, indices, vecs = ctx.saved_tensors
+        grad_dists = grad_vecs = None
+
+        if ctx.needs_input_grad[0]:
+            grad_dists = grad_output.mm(vecs.t())
+
+        if ctx.needs_input_grad[1]:
+            grads = values.unsqueeze(-1) * grad_output.unsqueeze(1)
+            grad_vecs = torch.zeros_like(vecs)
+            grad_vecs.index_add_(0, indices.view(-1),
+                                 grads.view(-1, vecs.size(1)))
+
+        return grad_dists, grad_vecs, None
+
+
+def topk_expected_vecs(dists, vecs, k):
+    """
+    Sparse version of the expectation of the vectors (dists.mm(vecs)),
+    using the top-k entries of each distribution (see TopkExpectation).
+
+    Args:
+        dists: 2D tensor (N x V) with the distributions
+        vecs: 2D tensor (V x E) with the vectors
+        k: the number of entries of each distribution to use
+
+    Returns: 2D tensor (N x E)
+
+    """
+    if k <= 0 or k >= vecs.size(0):
+        return dists.mm(vecs)
+
+    return TopkExpectation.apply(dists, vecs, k)
+
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """
+    Project the given vectors to the vocabulary and compute the
+    cross-entropy loss of each timestep, in chunks of timesteps.
+
+    Only the logits of one chunk exist at any time. In the backward pass
+    the logits of each chunk are recomputed, instead of being stored,
+    so the memory does not grow with the full [B x T x V] logits (and
+    their gradient).
+    """
+
+    @staticmethod
+    def forward(ctx, inputs, weight, bias, targets, chunk, ignore_index):
+        losses = []
+        for i in range(0, inputs.size(1), chunk):
+            logits = F.linear(inputs[:, i:i + chunk], weight, bias)
+            logits = logits.contiguous().view(-1, logits.size(-1))
+            _targets = targets[:, i:i + chunk]
+            loss = F.cross_entropy(logits, _targets.contiguous().view(-1),
+                                   ignore_index=ignore_index,
+                                   reduction='none')
+            losses.append(loss.view(_targets.size()))
+
+        ctx.save_for_backward(inputs, weight, bias, targets)
+        ctx.chunk = chunk
+        ctx.ignore_index = ignore_index
+
+        return torch.cat(losses, 1)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        inputs, weight, bias, targets = ctx.saved_tensors
+        grad_inputs = grad_weight = grad_bias = None
+
+        if ctx.needs_input_grad[0]:
+            grad_inputs = torch.zeros_like(inputs)
+        if ctx.needs_input_grad[1]:
+            grad_weight = torch.zeros_like(weight)
+        if bias is not None and ctx.needs_input_grad[2]:
+            grad_bias = torch.zeros_like(bias)
+
+        for i in range(0, inputs.size(1), ctx.chunk):
+            x = inputs[:, i:i + ctx.chunk]
+            _targets = targets[:, i:i + ctx.chunk]
+            g = grad_output[:, i:i + ctx.chunk]
+            g = g * (_targets != ctx.ignore_index).type_as(g)
+
+            # d(loss)/d(logits) = softmax(logits) - onehot(target)
+            d_logits = F.softmax(F.linear(x, weight, bias), -1)
+            d_logits.scatter_add_(-1, _targets.unsqueeze(-1),
+                                  -torch.ones_like(d_logits[..., :1]))
+            d_logits = d_logits * g.unsqueeze(-1)
+
+            if grad_inputs is not None:
+                grad_inputs[:, i:i + ctx.chunk] = d_logits.matmul(weight)
+
+            d_logits = d_logits.contiguous().view(-1, d_logits.size(-1))
+            if grad_weight is not None:
+                grad_weight += d_logits.t().mm(
+                    x.contiguous().view(-1, x.size(-1)))
+            if grad_bias is not None:
+                grad_bias += d_logits.sum(0)
+
+        return grad_inputs, grad_weight, grad_bias, None, None, None
+
+
+def chunked_cross_entropy(inputs, projection, targets, chunk,
+                          ignore_index=0):
+    """
+    Memory-efficient equivalent of
+    F.cross_entropy(projection(inputs), targets, reduction='none'),
+    computed in chunks of timesteps (see ChunkedCrossEntropy).
+
+    Args:
+        inputs: 3D tensor (B x T x H) with the vectors to be projected
+        projection: the linear layer, which projects them to the vocabulary
+        targets: 2D tensor (B x T) with the target token ids
+        chunk: the number of timesteps in each chunk
+        ignore_index: the target value, which is ignored (e.g. padding)
+
+    Returns: 2D tensor (B x T) with the loss of each timestep
+
+    """
+    return ChunkedCrossEntropy.apply(inputs, projection.weight,
+                                     projection.bias, targets, chunk,
+                                     ignore_index)
+
+
 def straight_softmax(logits, tau=1, hard=False, target_mask=None):
     y_soft = F.softmax(logits.squeeze() / tau, dim=1)
 
@@ -139,18 +283,27 @@ def aeq(*args):
         "Not all arguments have the same value: " + str(args)
 
 
-def module_grad_wrt_loss(optimizers, module, loss, prefix=None):
-    loss.backward(retain_graph=True)
-
-    grad_norms = [(n, p.grad.norm().item())
-                  for n, p in module.named_parameters()]
+def module_params(module, prefix=None):
+    """
+    The trainable parameters of a module, optionally only those whose
+    names start with the given prefix.
+    """
+    return [p for n, p in module.named_parameters()
+            if p.requires_grad and (prefix is None or n.startswith(prefix))]
 
-    if prefix is not None:
-        grad_norms = [g for g in grad_norms if g[0].startswith(prefix)]
 
-    mean_norm = mean([gn for n, gn in grad_norms])
+def grads_wrt_loss(params, loss):
+    """
+    The gradients of a loss wrt the given parameters. Unlike backward(),
+    only the part of the graph between the loss and the parameters is
+    traversed, the graph is retained and the .grad of the parameters
+    is left untouched.
+    """
+    grads = torch.autograd.grad(loss, params, retain_graph=True,
+                                allow_unused=True)
+    return [torch.zeros_like(p) if g is None else g
+            for p, g in zip(params, grads)]
 
-    for optimizer in optimizers:
-        optimizer.zero_grad()
 
-    return mean_norm
+def mean_grad_norm(grads):
+    return torch.stack([g.norm() for g in grads]).mean().item()
@@ -2,7 +2,8 @@ import torch
 from torch import nn
 from torch.autograd import Variable
 
-from modules.helpers import sequence_mask, masked_normalization_inf
+from modules.helpers import sequence_mask, masked_normalization_inf, \
+    topk_expected_vecs
 
 
 class GaussianNoise(nn.Module):
@@ -96,15 +97,21 @@ class Embed(nn.Module):
 
         return embeddings
 
-    def expectation(self, dists):
+    def expectation(self, dists, topk=0):
         """
         Obtain a weighted sum (expectation) of all the embeddings, from a
         given probability distribution.
 
+        Args:
+            dists: 3D tensor with the probability distributions
+            topk (int): if > 0, compute the expected embeddings using only
+                the k most probable tokens of each distribution
+
         """
         flat_probs = dists.contiguous().view(dists.size(0) * dists.size(1),
                                              dists.size(2))
-        flat_embs = flat_probs.mm(self.embedding.weight)
+        flat_embs = topk_expected_vecs(flat_probs, self.embedding.weight,
+                                       topk)
         embs = flat_embs.view(dists.size(0), dists.size(1), flat_embs.size(1))
 
         # apply layer normalization on the expectation
@@ -1,8 +1,18 @@
+from collections import namedtuple
+
 import torch
 from torch import nn
 from torch.nn import functional as F
 
-from modules.modules import RecurrentHelper, AttSeqDecoder, SeqReader
+from modules.modules import RecurrentHelper, AttSeqDecoder, SeqReader, \
+    drop_tokens
+
+# the outputs of Seq2Seq2Seq.forward. Besides the outputs of each encoder
+# and decoder, it exposes the intermediate tensors that the losses reuse:
+# - inp_embeddings: the embeddings of the input (before the word dropout)
+# - cmp_embeddings: the expected embeddings of the compression
+Seq3Output = namedtuple("Seq3Output", ["enc1", "dec1", "enc2", "dec2",
+                                       "inp_embeddings", "cmp_embeddings"])
 
 
 class Seq2Seq2Seq(nn.Module, RecurrentHelper):
@@ -28,8 +38,28 @@ class Seq2Seq2Seq(nn.Module, RecurrentHelper):
         self.dec_token_dropout = kwargs.get("dec_token_dropout", .0)
         self.enc_token_dropout = kwargs.get("enc_token_dropout", .0)
 
+        # compute the embeddings of the compression from the top-k tokens
+        # of each distribution. Used only with hard=True (see forward).
+        self.embed_topk = kwargs.get("embed_topk", 0)
+
+        # build only the layers that are needed for generating compressions
+        self.inference = kwargs.get("inference", False)
+
+        # weight / layer tying. The shared layers are created only once.
+        self.tie_embedding = kwargs.get("tie_embedding", False)
+        self.tie_decoder_outputs = kwargs.get("tie_decoder_outputs", False)
+        self.tie_embedding_outputs = kwargs.get("tie_embedding_outputs", False)
+        self.tie_decoders = kwargs.get("tie_decoders", False)
+        self.tie_encoders = kwargs.get("tie_encoders", False)
+
+        # the pretrained embeddings are shared by all the encoders/decoders,
+        # regardless of tie_embedding (see initialize_embeddings)
+        self.pretrained_embeddings = kwargs.get("pretrained_embeddings",
+                                                False)
+        self.share_embedding = self.tie_embedding or self.pretrained_embeddings
+
         # tie embedding layers to output layers (vocabulary projections)
-        kwargs["tie_weights"] = kwargs.get("tie_embedding_outputs", False)
+        kwargs["tie_weights"] = self.tie_embedding_outputs
 
         ############################################
         # Layers
@@ -38,17 +68,40 @@ class Seq2Seq2Seq(nn.Module, RecurrentHelper):
         # backward-compatibility for older version of the project
         kwargs["rnn_size"] = kwargs.get("enc_rnn_size", kwargs.get("rnn_size"))
         self.inp_encoder = SeqReader(self.n_tokens, **kwargs)
-        self.cmp_encoder = SeqReader(self.n_tokens, **kwargs)
+
+        # the embedding layer that is shared by all the encoders/decoders
+        embed = self.inp_encoder.embed if self.share_embedding else None
+
+        if not self.inference:
+            if self.tie_encoders:
+                self.cmp_encoder = self.inp_encoder
+            else:
+                self.cmp_encoder = SeqReader(self.n_tokens, embed=embed,
+                                             **kwargs)
 
         # backward-compatibility for older version of the project
         kwargs["rnn_size"] = kwargs.get("dec_rnn_size", kwargs.get("rnn_size"))
         enc_size = self.inp_encoder.rnn_size
-        self.compressor = AttSeqDecoder(self.n_tokens, enc_size, **kwargs)
-        self.decompressor = AttSeqDecoder(self.n_tokens, enc_size, **kwargs)
+        self.compressor = AttSeqDecoder(self.n_tokens, enc_size, embed=embed,
+                                        **kwargs)
+        if not self.inference:
+            if self.tie_decoders:
+                self.decompressor = self.compressor
+            else:
+                Wo = self.compressor.Wo if self.tie_decoder_outputs else None
+                self.decompressor = AttSeqDecoder(self.n_tokens, enc_size,
+                                                  embed=embed, Wo=Wo,
+                                                  **kwargs)
+
+        # without shared embeddings, tie the output layers
+        # to the embedding layer of the input encoder
+        if self.tie_embedding_outputs and not self.share_embedding:
+            for decoder in self._decoders():
+                decoder.Wo.weight = self.inp_encoder.embed.embedding.weight
 
         # create a dummy embedding layer, which will retrieve the idf values
         # of each word, given the word ids
-        if self.topic_idf:
+        if self.topic_idf and not self.inference:
             self.idf = nn.Embedding(num_embeddings=n_tokens, embedding_dim=1)
             self.idf.weight.requires_grad = False
 
@@ -79,9 +132,24 @@ class Seq2Seq2Seq(nn.Module, RecurrentHelper):
         self.src_bridge = nn.ModuleList([nn.Linear(enc_hidden_size,
                                                    dec_hidden_size)
                                          for _ in range(number_of_states)])
-        self.trg_bridge = nn.ModuleList([nn.Linear(enc_hidden_size,
-                                                   dec_hidden_size)
-                                         for _ in range(number_of_states)])
+        if not self.inference:
+            # with shared encoders and decoders, only one bridge is needed
+            if self.tie_encoders and self.tie_decoders:
+                self.trg_bridge = self.src_bridge
+            else:
+                self.trg_bridge = nn.ModuleList(
+                    [nn.Linear(enc_hidden_size, dec_hidden_size)
+                     for _ in range(number_of_states)])
+
+    @staticmethod
+    def inference_state_dict(state_dict):
+        """
+        Keep only the weights that are needed for generating compressions,
+        namely the weights of the input encoder, the compressor
+        and the bridge between them.
+        """
+        prefixes = ("inp_encoder.", "src_bridge.", "compressor.", "Wl")
+        return {k: v for k, v in state_dict.items() if k.startswith(prefixes)}
 
     def _bridge(self, bridge, hidden, src_lengths=None, trg_lengths=None):
         """Forward hidden state through bridge."""
@@ -126,27 +194,66 @@ class Seq2Seq2Seq(nn.Module, RecurrentHelper):
 
         return outs
 
+    @staticmethod
+    def _unique(modules):
+        # the tied modules appear more than once
+        unique = []
+        for m in modules:
+            if all(m is not x for x in unique):
+                unique.append(m)
+        return unique
+
+    def _encoders(self):
+        if self.inference:
+            return [self.inp_encoder]
+        return self._unique([self.inp_encoder, self.cmp_encoder])
+
+    def _decoders(self):
+        if self.inference:
+            return [self.compressor]
+        return self._unique([self.compressor, self.decompressor])
+
+    def _embeds(self):
+        return self._unique([m.embed for m in self._encoders()
+                             + self._decoders()])
+
     def initialize_embeddings(self, embs, trainable=False):
+        """
+        Copy the pretrained embeddings to the embedding layer, which is
+        shared by all the encoders/decoders. The model has to be created
+        with pretrained_embeddings=True (or tie_embedding=True).
+        The weights are copied in place, so that the tied layers
+        remain tied.
+        """
+        embeds = self._embeds()
+        if len(embeds) > 1:
+            raise ValueError("The pretrained embeddings are shared by all "
+                             "the layers. Create the model with "
+                             "pretrained_embeddings=True!")
 
-        freeze = not trainable
+        embeddings = torch.from_numpy(embs).float()
+        embeds[0].embedding.weight.data.copy_(embeddings)
+        embeds[0].embedding.weight.requires_grad = trainable
 
+    def initialize_output_embeddings(self, embs):
+        """
+        Initialize the output layers of the decoders, which are not tied
+        to an embedding layer, with the pretrained embeddings.
+        """
         embeddings = torch.from_numpy(embs).float()
-        embedding_layer = nn.Embedding.from_pretrained(embeddings, freeze)
+        embed_weights = [e.embedding.weight for e in self._embeds()]
 
-        self.inp_encoder.embed.embedding = embedding_layer
-        self.cmp_encoder.embed.embedding = embedding_layer
-        self.compressor.embed.embedding = embedding_layer
-        self.decompressor.embed.embedding = embedding_layer
+        for Wo in self._unique([d.Wo for d in self._decoders()]):
+            if all(Wo.weight is not w for w in embed_weights):
+                Wo.weight.data.copy_(embeddings)
 
     def initialize_embeddings_idf(self, idf):
         idf_embs = torch.from_numpy(idf).float().unsqueeze(-1)
         self.idf = nn.Embedding.from_pretrained(idf_embs, freeze=True)
 
     def set_embedding_gradient_mask(self, mask):
-        self.inp_encoder.embed.set_grad_mask(mask)
-        self.cmp_encoder.embed.set_grad_mask(mask)
-        self.compressor.embed.set_grad_mask(mask)
-        self.decompressor.embed.set_grad_mask(mask)
+        for embed in self._embeds():
+            embed.set_grad_mask(mask)
 
     def _fake_inputs(self, inputs, latent_lengths, pad=1):
         batch_size, seq_len = inputs.size()
@@ -180,7 +287,7 @@ class Seq2Seq2Seq(nn.Module, RecurrentHelper):
 
     def forward(self, inp_src, inp_trg,
                 src_lengths, latent_lengths,
-                sampling, tau=1, hard=True):
+                sampling, tau=1, hard=True, project=True):
 
         """
         This approach utilizes 4 RNNs. The latent representation is obtained
@@ -196,12 +303,27 @@ class Seq2Seq2Seq(nn.Module, RecurrentHelper):
                            ^
         L1-encoder -> L2-decoder
 
+        If project=False, the reconstruction decoder does not compute its
+        logits, but returns its contexts (see AttSeqDecoder.forward), which
+        are projected to the vocabulary as part of the (chunked) loss.
+
+        Returns:
+            Seq3Output: the outputs of each encoder and decoder, and the
+                embeddings of the input and of the compression
+
         """
         # --------------------------------------------
         # ENCODER-1 (Compression)
         # --------------------------------------------
-        enc1_results = self.inp_encoder(inp_src, None, src_lengths,
-                                        word_dropout=self.enc_token_dropout)
+        inp_embeddings = self.inp_encoder.embed(inp_src)
+
+        enc1_embeddings = inp_embeddings
+        if self.enc_token_dropout > 0:
+            enc1_embeddings, _ = drop_tokens(inp_embeddings,
+                                             self.enc_token_dropout)
+
+        enc1_results = self.inp_encoder.read_embs(enc1_embeddings, None,
+                                                  src_lengths)
         outs_enc1, hn_enc1 = enc1_results[-2:]
 
         # --------------------------------------------
@@ -214,12 +336,15 @@ class Seq2Seq2Seq(nn.Module, RecurrentHelper):
                                        enc_lengths=src_lengths,
                                        sampling_prob=1., hard=hard, tau=tau,
                                        desired_lengths=latent_lengths)
-        logits_dec1, outs_dec1, _, dists_dec1, _, _ = dec1_results
 
         # --------------------------------------------
         # ENCODER-2 (Reconstruction)
         # --------------------------------------------
-        cmp_embeddings = self.compressor.embed.expectation(dists_dec1)
+        # with hard=True the distributions are one-hot in the forward pass,
+        # so the top-k tokens give the exact expectation
+        topk = self.embed_topk if hard else 0
+        cmp_embeddings = self.compressor.embed.expectation(dec1_results.dists,
+                                                           topk=topk)
         cmp_lengths = latent_lengths - 1
 
         # !!! Limit the communication only through the embs
@@ -241,6 +366,9 @@ class Seq2Seq2Seq(nn.Module, RecurrentHelper):
                                          sampling_prob=sampling,
                                          tau=tau,
                                          desired_lengths=dec2_lengths,
-                                         word_dropout=self.dec_token_dropout)
+                                         word_dropout=self.dec_token_dropout,
+                                         project=project)
 
-        return enc1_results, dec1_results, enc2_results, dec2_results
+        return Seq3Output(enc1_results, dec1_results,
+                          enc2_results, dec2_results,
+                          inp_embeddings, cmp_embeddings)
@@ -1,3 +1,5 @@
+from collections import namedtuple
+
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -6,6 +8,12 @@ from torch.nn.utils.rnn import pad_packed_sequence, pack_padded_sequence
 from modules.helpers import straight_softmax, gumbel_softmax
 from modules.layers import Embed, Attention
 
+# the outputs of AttSeqDecoder. They are also accessible by position,
+# in the order: logits, outputs, state, dists, attentions, taus, contexts
+DecoderOutput = namedtuple("DecoderOutput", ["logits", "outputs", "state",
+                                             "dists", "attentions", "taus",
+                                             "contexts"])
+
 
 class RecurrentHelper:
     @staticmethod
@@ -75,16 +83,8 @@ class RecurrentHelper:
                 original order
 
         """
-        batch_size = lengths.size(0)
-
-        sorted_lengths, sorted_idx = lengths.sort()
-        _, original_idx = sorted_idx.sort(0, descending=True)
-        reverse_idx = torch.linspace(batch_size - 1, 0, batch_size).long()
-
-        if lengths.data.is_cuda:
-            reverse_idx = reverse_idx.cuda()
-
-        sorted_lengths = sorted_lengths[reverse_idx]
+        sorted_lengths, sorted_idx = lengths.sort(descending=True)
+        _, original_idx = sorted_idx.sort()
 
         def sort(iterable):
 
@@ -92,7 +92,7 @@ class RecurrentHelper:
                 return None
 
             if len(iterable.shape) > 1:
-                return iterable[sorted_idx][reverse_idx]
+                return iterable[sorted_idx]
             else:
                 return iterable
 
@@ -102,7 +102,7 @@ class RecurrentHelper:
                 return None
 
             if len(iterable.shape) > 1:
-                return iterable[reverse_idx][original_idx][reverse_idx]
+                return iterable[original_idx]
             else:
                 return iterable
 
@@ -210,26 +210,36 @@ class RNNModule(nn.Module, RecurrentHelper):
 
         if lengths is not None and self.pack:
 
+            # the lengths of a PackedSequence live on the cpu.
+            # batches that are already sorted (by the sampler), are packed
+            # as they are, without any reordering
+            lengths_sorted = lengths.cpu()
+            presorted = (lengths_sorted[:-1] >= lengths_sorted[1:]).all()
+
             ###############################################
             # sorting
             ###############################################
-            lenghts_sorted, sorted_i = lengths.sort(descending=True)
-            _, reverse_i = sorted_i.sort()
+            if not presorted:
+                lengths_sorted, sorted_i = lengths_sorted.sort(descending=True)
+                _, reverse_i = sorted_i.sort()
+                sorted_i = sorted_i.to(x.device)
+                reverse_i = reverse_i.to(x.device)
 
-            x = x[sorted_i]
+                x = x[sorted_i]
 
-            if hidden is not None:
-                hidden = self.reorder_hidden(hidden, sorted_i)
+                if hidden is not None:
+                    hidden = self.reorder_hidden(hidden, sorted_i)
 
             ###############################################
             # forward
             ###############################################
 
             if self.countdown:
-                ticks = length_countdown(lenghts_sorted).float() * self.Wt
+                ticks = length_countdown(lengths_sorted.to(x.device))
+                ticks = ticks.float() * self.Wt
                 x = torch.cat([x, ticks.unsqueeze(-1)], -1)
 
-            packed = pack_padded_sequence(x, lenghts_sorted, batch_first=True)
+            packed = pack_padded_sequence(x, lengths_sorted, batch_first=True)
 
             self.rnn.flatten_parameters()
             out_packed, hidden = self.rnn(packed, hidden)
@@ -238,13 +248,14 @@ class RNNModule(nn.Module, RecurrentHelper):
                                                          batch_first=True,
                                                          total_length=max_length)
 
-            out_unpacked = self.dropout(out_unpacked)
+            outputs = self.dropout(out_unpacked)
 
             ###############################################
             # un-sorting
             ###############################################
-            outputs = out_unpacked[reverse_i]
-            hidden = self.reorder_hidden(hidden, reverse_i)
+            if not presorted:
+                outputs = outputs[reverse_i]
+                hidden = self.reorder_hidden(hidden, reverse_i)
 
         else:
             # todo: make hidden return the true last states
@@ -260,7 +271,14 @@ class RNNModule(nn.Module, RecurrentHelper):
 
 
 class SeqReader(nn.Module, RecurrentHelper):
-    def __init__(self, ntokens, **kwargs):
+    def __init__(self, ntokens, embed=None, **kwargs):
+        """
+
+        Args:
+            ntokens: the size of the vocabulary
+            embed (Embed): an existing embedding layer to use (share),
+                instead of creating a new one
+        """
         super(SeqReader, self).__init__()
 
         ############################################
@@ -282,8 +300,12 @@ class SeqReader(nn.Module, RecurrentHelper):
         ############################################
         # Layers
         ############################################
-        self.embed = Embed(ntokens, self.emb_size,
-                           noise=self.embed_noise, dropout=self.embed_dropout)
+        if embed is not None:
+            self.embed = embed
+        else:
+            self.embed = Embed(ntokens, self.emb_size,
+                               noise=self.embed_noise,
+                               dropout=self.embed_dropout)
 
         self.encoder = RNNModule(input_size=self.emb_size,
                                  rnn_size=self.rnn_size,
@@ -362,7 +384,17 @@ class SeqReader(nn.Module, RecurrentHelper):
 
 
 class AttSeqDecoder(nn.Module):
-    def __init__(self, trg_ntokens, enc_size, **kwargs):
+    def __init__(self, trg_ntokens, enc_size, embed=None, Wo=None, **kwargs):
+        """
+
+        Args:
+            trg_ntokens: the size of the target vocabulary
+            enc_size: the size of the outputs of the encoder
+            embed (Embed): an existing embedding layer to use (share),
+                instead of creating a new one
+            Wo (nn.Linear): an existing output layer to use (share),
+                instead of creating a new one
+        """
         super(AttSeqDecoder, self).__init__()
 
         ############################################
@@ -388,9 +420,12 @@ class AttSeqDecoder(nn.Module):
         ############################################
         # Layers
         ############################################
-        self.embed = Embed(trg_ntokens, emb_size,
-                           noise=embed_noise,
-                           dropout=embed_dropout)
+        if embed is not None:
+            self.embed = embed
+        else:
+            self.embed = Embed(trg_ntokens, emb_size,
+                               noise=embed_noise,
+                               dropout=embed_dropout)
 
         # the output size of the ho token: ho = [ h || c]
         if tie_weights:
@@ -431,7 +466,10 @@ class AttSeqDecoder(nn.Module):
         self.Wc = nn.Linear(rnn_size + enc_size, self.ho_size)
 
         # projection layer to the vocabulary
-        self.Wo = nn.Linear(self.ho_size, trg_ntokens)
+        if Wo is not None:
+            self.Wo = Wo
+        else:
+            self.Wo = nn.Linear(self.ho_size, trg_ntokens)
 
         if self.layer_norm:
             self.norm_ctx = nn.LayerNorm(self.ho_size)
@@ -547,7 +585,8 @@ class AttSeqDecoder(nn.Module):
 
         return ho
 
-    def step(self, embs, enc_outputs, state, enc_lengths, ho=None, tick=None):
+    def step(self, embs, enc_outputs, state, enc_lengths, ho=None, tick=None,
+             project=True):
         """
         Perform one decoding step.
         1. Construct the input. If input-feeding is used, then the input is the
@@ -567,6 +606,8 @@ class AttSeqDecoder(nn.Module):
             ho:
             enc_lengths:
             tick:
+            project: project the context-aware vector to the vocabulary.
+                If False, the returned logits are None.
       Returns:
 
         """
@@ -602,13 +643,13 @@ class AttSeqDecoder(nn.Module):
             ho = torch.tanh(ho)
 
         # 5. Project the context-aware vector to the vocabulary.
-        dec_logits = self.Wo(ho)
+        dec_logits = self.Wo(ho) if project else None
 
         return dec_logits, outputs, state, ho, att_scores
 
     def forward(self, gold_tokens, enc_outputs, init_hidden, enc_lengths,
                 sampling_prob=0.0, argmax=False, hard=False, tau=1.0,
-                desired_lengths=None, word_dropout=0):
+                desired_lengths=None, word_dropout=0, project=True):
         """
 
         Args:
@@ -622,8 +663,18 @@ class AttSeqDecoder(nn.Module):
             tau:
             desired_lengths:
             word_dropout:
+            project: project the outputs to the vocabulary. If False,
+                the logits are not computed (unless they are needed for
+                sampling) and the context-aware vectors (contexts),
+                from which they are computed, are returned instead.
+                Used for computing the loss without the full logits.
 
         Returns:
+            DecoderOutput: the logits, the outputs of the RNN, the last state,
+                the distributions of the sampled tokens, the attention
+                scores, the learned temperatures of each timestep
+                and the contexts (only if project=False).
+
             Note: dists contain one less element than logits, because
             we do not care about sampling from the last timestep as it will not
             be used for sampling another token. The last timestep should
@@ -639,6 +690,10 @@ class AttSeqDecoder(nn.Module):
         attentions = []
         dists = []
         taus = []
+        contexts = []
+
+        # the logits are needed for sampling the next token
+        project = project or sampling_prob > 0
 
         # initial hidden state of the decoder, and initial context
         state = init_hidden
@@ -663,13 +718,17 @@ class AttSeqDecoder(nn.Module):
 
             # perform one decoding step
             _logits, outs, state, ho, att = self.step(e_i, enc_outputs, state,
-                                                      enc_lengths, ho, tick)
+                                                      enc_lengths, ho, tick,
+                                                      project)
 
             if self.learn_tau and self.training:
                 tau = 1 / (self.softplus(ho.squeeze()) + self.tau_0)
                 taus.append(tau)
 
-            logits.append(_logits)
+            if project:
+                logits.append(_logits)
+            else:
+                contexts.append(ho)
             outputs.append(outs)
             attentions.append(att)
 
@@ -677,7 +736,6 @@ class AttSeqDecoder(nn.Module):
                 dists.append(d_i)
 
         outputs = torch.cat(outputs, dim=1).contiguous()
-        logits = torch.cat(logits, dim=1).contiguous()
         attentions = torch.stack(attentions, dim=1).contiguous()
 
         if len(dists) > 0:
@@ -688,4 +746,12 @@ class AttSeqDecoder(nn.Module):
         if len(taus) > 0:
             taus = torch.stack(taus, dim=1).squeeze()
 
-        return logits, outputs, state, dists, attentions, taus
+        if project:
+            logits = torch.cat(logits, dim=1).contiguous()
+            contexts = None
+        else:
+            logits = None
+            contexts = torch.cat(contexts, dim=1).contiguous()
+
+        return DecoderOutput(logits, outputs, state, dists, attentions, taus,
+                             contexts)
@@ -3,6 +3,8 @@ import math
 import numpy
 import torch
 
+from modules.data.loaders import DevicePrefetcher, MultiLoader
+
 
 class BaseTrainer:
     def __init__(self, train_loader, valid_loader,
@@ -11,12 +13,21 @@ class BaseTrainer:
                  parallel=False,
                  **kwargs):
 
-        self.train_loader = train_loader
-        self.valid_loader = valid_loader
         self.device = device
         self.loss_weights = loss_weights
 
         self.config = config
+
+        # the mixer of the training corpora, whose progress is checkpointed
+        self.mixer = None
+        if isinstance(train_loader, MultiLoader):
+            self.mixer = train_loader
+
+        # move the batches to the device ahead of time, in the background
+        self.prefetch = self.config.get("prefetch", 0)
+        self.train_loader = self._prefetched(train_loader)
+        self.valid_loader = self._prefetched(valid_loader)
+
         self.log_interval = self.config["log_interval"]
         self.batch_size = self.config["batch_size"]
         self.checkpoint_interval = self.config["checkpoint_interval"]
@@ -33,8 +44,8 @@ class BaseTrainer:
         self.progress_log = None
 
         # init dataset
-        self.train_set_size = self._get_dataset_size(self.train_loader)
-        self.val_set_size = self._get_dataset_size(self.valid_loader)
+        self.train_set_size = self._get_dataset_size(train_loader)
+        self.val_set_size = self._get_dataset_size(valid_loader)
 
         self.n_batches = math.ceil(
             float(self.train_set_size) / self.batch_size)
@@ -53,13 +64,26 @@ class BaseTrainer:
 
         return seq
 
+    def _prefetched(self, loader):
+        if not self.prefetch or loader is None:
+            return loader
+
+        if isinstance(loader, (tuple, list)):
+            return type(loader)(self._prefetched(x) for x in loader)
+
+        return DevicePrefetcher(loader, self.device, depth=self.prefetch)
+
     @staticmethod
     def _get_dataset_size(loader):
         """
         If the trainer holds multiple datasets, then the size
         is estimated based on the largest one.
+        If the datasets are mixed (MultiLoader), then the size
+        is the expected number of samples in an epoch.
         """
-        if isinstance(loader, (tuple, list)):
+        if isinstance(loader, MultiLoader):
+            return loader.n_samples
+        elif isinstance(loader, (tuple, list)):
             return len(loader[0].dataset)
         else:
             return len(loader.dataset)
@@ -84,7 +108,9 @@ class BaseTrainer:
         return _val
 
     def _tensors_to_device(self, batch):
-        return list(map(lambda x: x.to(self.device), batch))
+        # a no-op for the batches that are already on the device (prefetched)
+        return list(map(lambda x: x.to(self.device, non_blocking=True),
+                        batch))
 
     def _batch_to_device(self, batch):
 
@@ -97,63 +123,56 @@ class BaseTrainer:
 
     @staticmethod
     def _multi_dataset_iter(loader, strategy, step=1):
-        # todo: generalize to N datasets. For now works only with 2.
-        sizes = [len(x) for x in loader]
+        """
+        Iterate over multiple loaders in parallel. The first loader is
+        the primary one, which defines the length of the epoch, and the
+        batches of the other (auxiliary) loaders are yielded along with it.
+
+        Strategies:
+            spread: spread the batches of each auxiliary loader
+                evenly over the epoch
+            modulo: add the auxiliary batches every `step` steps,
+                restarting the exhausted auxiliary loaders
+            cycle: add the auxiliary batches in every step,
+                restarting the exhausted auxiliary loaders
+            beginning: add the auxiliary batches in every step,
+                until the auxiliary loaders are exhausted
+        """
+        if strategy not in ["spread", "modulo", "cycle", "beginning"]:
+            raise ValueError("Invalid iteration strategy!")
 
-        iter_a = iter(loader[0])
-        iter_b = iter(loader[1])
+        sizes = [len(x) for x in loader]
+        iters = [iter(x) for x in loader]
 
+        # the interval of the batches of each auxiliary loader
         if strategy == "spread":
-            step = math.floor((sizes[0] - sizes[1]) / (sizes[1] - 1))
-
-            for i in range(max(sizes)):
-                if i % (step + 1) == 0:
-                    batch_a = next(iter_a)
-                    batch_b = next(iter_b, None)
-
-                    if batch_b is not None:
-                        yield batch_a, batch_b
-                    else:
-                        yield batch_a
-                else:
-                    yield next(iter_a)
-
-        if strategy == "modulo":
-            for i in range(max(sizes)):
-                if i % step == 0:
-                    batch_a = next(iter_a)
-                    batch_b = next(iter_b, None)
-
-                    if batch_b is None:  # reset iterator b
-                        iter_b = iter(loader[1])
-                        batch_b = next(iter_b, None)
-
-                    yield batch_a, batch_b
-                else:
-                    yield next(iter_a)
-
-        elif strategy == "cycle":
-            for i in range(max(sizes)):
-                batch_a = next(iter_a)
-                batch_b = next(iter_b, None)
-
-                if batch_b is None:  # reset iterator b
-                    iter_b = iter(loader[1])
-                    batch_b = next(iter_b, None)
-
-                yield batch_a, batch_b
-
-        elif strategy == "beginning":
-            for i in range(max(sizes)):
-                batch_a = next(iter_a)
-                batch_b = next(iter_b, None)
-
-                if batch_b is not None:
-                    yield batch_a, batch_b
-                else:
-                    yield batch_a
+            steps = [math.floor((sizes[0] - size) / max(size - 1, 1)) + 1
+                     for size in sizes]
+        elif strategy == "modulo":
+            steps = [step] * len(loader)
         else:
-            raise ValueError("Invalid iteration strategy!")
+            steps = [1] * len(loader)
+
+        for i in range(sizes[0]):
+            batches = [next(iters[0])]
+
+            for k in range(1, len(loader)):
+                if i % steps[k] != 0:
+                    continue
+
+                batch = next(iters[k], None)
+
+                if batch is None and strategy in ["modulo", "cycle"]:
+                    iters[k] = iter(loader[k])  # restart the loader
+                    batch = next(iters[k], None)
+
+                if batch is not None:
+                    batches.append(batch)
+
+            if len(batches) == 1:
+                yield batches[0]
+            else:
+                yield tuple(batches)
 
     def _dataset_iterator(self, loader, strategy=None, step=1):
         # if all datasets have the same size
@@ -173,7 +192,8 @@ class BaseTrainer:
 
         Returns:
             loss_sum (int): the aggregation of the constituent losses
-            loss_list (list, int): the constituent losses
+            loss_list (torch.Tensor): the constituent (weighted) losses,
+                detached and on the device, in order to avoid a host sync
 
         """
         if isinstance(batch_losses, (tuple, list)):
@@ -184,14 +204,14 @@ class BaseTrainer:
 
             if loss_weights is None:
                 loss_sum = sum(batch_losses)
-                loss_list = [x.item() for x in batch_losses]
+                loss_list = torch.stack([x.detach() for x in batch_losses])
             else:
                 loss_sum = sum(w * x for x, w in
                                zip(batch_losses, loss_weights))
 
-                loss_list = [w * x.item() for x, w in
-                             zip(batch_losses, loss_weights)]
+                loss_list = torch.stack([w * x.detach() for x, w in
+                                         zip(batch_losses, loss_weights)])
         else:
             loss_sum = batch_losses
-            loss_list = batch_losses.item()
+            loss_list = batch_losses.detach()
         return loss_sum, loss_list
@@ -0,0 +1,48 @@
+import torch
+
+
+class LossHistory(object):
+    """
+    A list of the (per step) losses, which are appended as (detached)
+    tensors, without transferring them to the host.
+    The pending tensors are transferred all together (with a single sync),
+    only when the history is accessed, e.g. once per log interval.
+    Each element is a float, or a list of floats for multiple losses.
+    """
+
+    def __init__(self):
+        self._values = []
+        self._pending = []
+
+    def append(self, value):
+        if torch.is_tensor(value):
+            self._pending.append(value.detach())
+        else:
+            self._flush()
+            self._values.append(value)
+
+    def _flush(self):
+        if len(self._pending) == 0:
+            return
+
+        values = torch.cat([x.reshape(-1) for x in self._pending]).tolist()
+
+        i = 0
+        for x in self._pending:
+            n = x.numel()
+            self._values.append(values[i] if x.dim() == 0
+                                else values[i:i + n])
+            i += n
+
+        self._pending = []
+
+    def __len__(self):
+        return len(self._values) + len(self._pending)
+
+    def __getitem__(self, index):
+        self._flush()
+        return self._values[index]
+
+    def __iter__(self):
+        self._flush()
+        return iter(self._values)
@@ -0,0 +1,158 @@
+import os
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy
+import torch
+from tabulate import tabulate
+
+
+class StepProfiler:
+    """
+    Lightweight instrumentation of the training steps.
+    It records the wall time of each phase of a step (e.g. data loading,
+    forward, backward), and keeps the timings of the last `window` steps,
+    from which it reports rolling percentiles.
+
+    The timings of the same phase within a step are accumulated and phases
+    may be nested (e.g. the losses within the forward pass).
+    """
+
+    def __init__(self, window=100, sync=False, trace=None, trace_dir=None,
+                 enabled=True):
+        """
+
+        Args:
+            window (int): the number of (most recent) steps to keep
+            sync (bool): synchronize with the GPU at the boundaries of each
+                phase. Required for accurate timings on the GPU, but adds
+                a small overhead.
+            trace (list): [start, steps]. If given, capture a trace
+                with the torch profiler for the given window of steps.
+            trace_dir (str): the directory to write the trace to
+            enabled (bool): enable/disable the profiler
+        """
+        self.window = window
+        self.sync = sync and torch.cuda.is_available()
+        self.trace = trace
+        self.trace_dir = trace_dir
+        self.enabled = enabled
+
+        self.timings = defaultdict(lambda: deque(maxlen=self.window))
+        self._current = defaultdict(float)
+        self._last_step = None
+        self._steps = 0
+        self._profiler = None
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the enclosed block, as part of the given phase.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        # label the phase in the trace (only in newer versions of pytorch)
+        record = None
+        if self._profiler is not None and hasattr(torch.autograd.profiler,
+                                                  "record_function"):
+            record = torch.autograd.profiler.record_function(name)
+            record.__enter__()
+
+        start = self._now()
+        try:
+            yield
+        finally:
+            self._current[name] += self._now() - start
+
+            if record is not None:
+                record.__exit__(None, None, None)
+
+    def iterate(self, iterable, name="data"):
+        """
+        Iterate over the given iterable (e.g. a DataLoader) and time
+        how long it takes to get each item.
+        """
+        # don't count the time since the previous epoch in the first step
+        self._last_step = None
+
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def step(self):
+        """
+        Mark the end of a step. The accumulated timings of the phases
+        of the step are added to the rolling windows.
+        """
+        if not self.enabled:
+            return
+
+        now = self._now()
+        if self._last_step is not None:
+            self._current["total"] = now - self._last_step
+        self._last_step = now
+
+        for name, value in self._current.items():
+            self.timings[name].append(value)
+        self._current.clear()
+
+        self._steps += 1
+        self._update_trace()
+
+    def _update_trace(self):
+        if self.trace is None:
+            return
+
+        start, steps = self.trace
+
+        if self._steps == start:
+            # torch.profiler is available only in newer versions of pytorch
+            if hasattr(torch, "profiler"):
+                self._profiler = torch.profiler.profile(record_shapes=True)
+            else:
+                self._profiler = torch.autograd.profiler.profile(
+                    use_cuda=torch.cuda.is_available())
+            self._profiler.__enter__()
+
+        elif self._steps == start + steps and self._profiler is not None:
+            self._profiler.__exit__(None, None, None)
+
+            trace_dir = self.trace_dir or os.getcwd()
+            trace_file = os.path.join(trace_dir,
+                                      f"trace_{start}-{start + steps}.json")
+            self._profiler.export_chrome_trace(trace_file)
+            self._profiler = None
+            print(f"Saved the profiler trace to {trace_file}")
+
+    def percentiles(self, q=(50, 90, 99)):
+        """
+        Returns:
+            dict: the percentiles (in ms) of the timings of each phase,
+                over the last `window` steps. {phase: {"p50": ..., ...}}
+        """
+        return {name: {f"p{p}": v for p, v in
+                       zip(q, numpy.percentile(values, q) * 1000)}
+                for name, values in self.timings.items() if len(values) > 0}
+
+    def summary(self, q=(50, 90, 99)):
+        """
+        Returns:
+            str: a table with the percentiles of the timings of each phase
+        """
+        stats = self.percentiles(q)
+        rows = [[name] + list(stats[name].values()) for name in stats]
+        return tabulate(rows, floatfmt=".2f",
+                        headers=["phase"] + [f"p{p} (ms)" for p in q])
@@ -5,6 +5,8 @@ import torch
 from torch.nn.utils import clip_grad_norm_
 
 from modules.training.base_trainer import BaseTrainer
+from modules.training.history import LossHistory
+from modules.training.profiler import StepProfiler
 from utils._logging import epoch_progress
 from utils.training import save_checkpoint
 
@@ -34,9 +36,20 @@ class Trainer(BaseTrainer):
         if not isinstance(self.optimizers, (tuple, list)):
             self.optimizers = [self.optimizers]
 
+        # per-phase timings of the training steps
+        self.profiler = StepProfiler(**self.config.get("profiler", {}))
+
     def _process_batch(self, *args):
         raise NotImplementedError
 
+    def _after_backward(self, batch_outputs):
+        """
+        Called after the backward pass and before the gradients are clipped
+        and the weights are updated. Override it, in order to inspect
+        the gradients of a step.
+        """
+        pass
+
     def _seq_loss(self, logits, labels):
 
         """
@@ -52,11 +65,24 @@ class Trainer(BaseTrainer):
 
     def grads(self):
         """
-        Get the list of the norms of the gradients for each parameter
+        Get the list of the norms of the gradients for each parameter.
+        The norms are computed on the device and are transferred all together.
         """
-        return [(name, parameter.grad.norm().item())
-                for name, parameter in self.model.named_parameters()
-                if parameter.requires_grad and parameter.grad is not None]
+        named_grads = [(n, p.grad) for n, p in self.model.named_parameters()
+                       if p.requires_grad and p.grad is not None]
+
+        if len(named_grads) == 0:
+            return []
+
+        names, grads = zip(*named_grads)
+
+        # batched norms, available only in newer versions of pytorch
+        if hasattr(torch, "_foreach_norm"):
+            norms = torch._foreach_norm(list(grads))
+        else:
+            norms = [g.norm() for g in grads]
+
+        return list(zip(names, torch.stack(norms).tolist()))
 
     def train_epoch(self):
         """
@@ -70,13 +96,15 @@ class Trainer(BaseTrainer):
 
         """
         self.model.train()
-        losses = []
+        losses = LossHistory()
 
         self.epoch += 1
         epoch_start = time.time()
 
+        profiler = self.profiler
+
         iterator = self._dataset_iterator(self.train_loader)
-        for i_batch, batch in enumerate(iterator, 1):
+        for i_batch, batch in enumerate(profiler.iterate(iterator), 1):
 
             self.step += 1
 
@@ -84,28 +112,36 @@ class Trainer(BaseTrainer):
             for optimizer in self.optimizers:
                 optimizer.zero_grad()
 
-            batch = self._batch_to_device(batch)
+            with profiler.phase("to_device"):
+                batch = self._batch_to_device(batch)
 
             # return here only the first batch losses, in order to avoid
             # breaking the existing framework
-            batch_losses, batch_outputs = self._process_batch(*batch)
+            with profiler.phase("forward"):
+                batch_losses, batch_outputs = self._process_batch(*batch)
 
             # aggregate the losses into a single loss value
-            loss_sum, loss_list = self._aggregate_losses(batch_losses)
-            losses.append(loss_list)
+            with profiler.phase("aggregate"):
+                loss_sum, loss_list = self._aggregate_losses(batch_losses)
+                losses.append(loss_list)
 
             # back-propagate
-            loss_sum.backward()
+            with profiler.phase("backward"):
+                loss_sum.backward()
+
+            self._after_backward(batch_outputs)
 
             if self.clip is not None:
                 # clip_grad_norm_(self.model.parameters(), self.clip)
-                for optimizer in self.optimizers:
-                    clip_grad_norm_((p for group in optimizer.param_groups
-                                     for p in group['params']), self.clip)
+                with profiler.phase("clip"):
+                    for optimizer in self.optimizers:
+                        clip_grad_norm_((p for group in optimizer.param_groups
+                                         for p in group['params']), self.clip)
 
             # update weights
-            for optimizer in self.optimizers:
-                optimizer.step()
+            with profiler.phase("optimizer"):
+                for optimizer in self.optimizers:
+                    optimizer.step()
 
             if self.step % self.log_interval == 0:
                 self.progress_log = epoch_progress(self.epoch, i_batch,
@@ -113,9 +149,14 @@ class Trainer(BaseTrainer):
                                                    self.train_set_size,
                                                    epoch_start)
 
-            for c in self.batch_end_callbacks:
-                if callable(c):
-                    c(batch, losses, loss_list, batch_outputs)
+            with profiler.phase("callbacks"):
+                for c in self.batch_end_callbacks:
+                    if callable(c):
+                        c(batch, losses, loss_list, batch_outputs)
+
+            profiler.step()
+
+        losses = list(losses)
         try:
             return numpy.array(losses).mean(axis=0)
         except:  # parallel losses
@@ -131,7 +172,7 @@ class Trainer(BaseTrainer):
 
         """
         self.model.eval()
-        losses = []
+        losses = LossHistory()
 
         iterator = self._dataset_iterator(self.valid_loader)
         with torch.no_grad():
@@ -144,7 +185,7 @@ class Trainer(BaseTrainer):
                 loss, _losses = self._aggregate_losses(batch_losses)
                 losses.append(_losses)
 
-        return numpy.array(losses).mean(axis=0)
+        return numpy.array(list(losses)).mean(axis=0)
 
     def get_state(self):
         """
@@ -164,6 +205,9 @@ class Trainer(BaseTrainer):
             "optimizers": [x.state_dict() for x in self.optimizers],
         }
 
+        if self.mixer is not None:
+            state["mixer"] = self.mixer.state_dict()
+
         return state
 
     def checkpoint(self, name=None, timestamp=False, tags=None, verbose=False):
@@ -0,0 +1,250 @@
+import json
+import os
+import threading
+import time
+from queue import Queue, Empty
+
+from mylogger.store import MetricStore
+
+
+def _to_json(obj):
+    if hasattr(obj, "tolist"):  # numpy arrays and tensors
+        return obj.tolist()
+    return getattr(obj, '__dict__', str(obj))
+
+
+class JsonlSink:
+    """
+    Append the events to a local JSONL file (one event per line).
+    """
+
+    def __init__(self, filename, types=None):
+        """
+
+        Args:
+            filename (str): the file to append the events to
+            types (list): write only the events of the given types
+        """
+        self.filename = filename
+        self.types = types
+
+    def write(self, events):
+        if self.types is not None:
+            events = [e for e in events if e["type"] in self.types]
+            if len(events) == 0:
+                return
+
+        lines = [json.dumps(e, default=_to_json) for e in events]
+        with open(self.filename, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def close(self):
+        pass
+
+
+class MetricStoreSink:
+    """
+    Append the values of the metrics to a (columnar) MetricStore.
+    The store is compacted when the logger is closed.
+    """
+
+    def __init__(self, filename):
+        self.store = MetricStore(filename)
+
+    def write(self, events):
+        for e in events:
+            if e["type"] == "metric":
+                self.store.append(e["key"], e["step"], e["value"], e["time"],
+                                  e["tag"])
+        self.store.flush()
+
+    def close(self):
+        self.store.compact()
+
+
+class VisdomSink:
+    """
+    Plot the events to Visdom.
+    The values (text, scatter etc.) replace their previous state,
+    so only the last update of each value in a batch is plotted.
+    """
+
+    def __init__(self, viz):
+        self.viz = viz
+
+    def _plot(self, event):
+        plot = event["plot"]
+
+        if plot == "line":
+            self.viz.plot_line(event["y"], event["x"], event["title"],
+                               event["legend"])
+        elif plot == "text":
+            self.viz.plot_text(event["value"], event["title"],
+                               pre=event["pre"])
+        elif plot == "scatter":
+            self.viz.plot_scatter(event["value"][0], event["value"][1],
+                                  event["title"])
+        elif plot == "heatmap":
+            self.viz.plot_heatmap(event["value"][0], event["value"][1],
+                                  event["title"])
+        elif plot == "bar":
+            self.viz.plot_bar(event["value"][0], event["value"][1],
+                              event["title"])
+        else:
+            raise NotImplementedError
+
+    def write(self, events):
+        events = [e for e in events if "plot" in e]
+
+        last_values = {e["key"]: i for i, e in enumerate(events)
+                       if e["type"] == "value"}
+
+        for i, event in enumerate(events):
+            if event["type"] == "value" and last_values[event["key"]] != i:
+                continue
+            try:
+                self._plot(event)
+            except Exception:
+                print(f"An error occurred while trying to plot "
+                      f"{event['type']}:{event['key']}")
+
+    def close(self):
+        pass
+
+
+class MongoSink:
+    """
+    Insert the events to a MongoDB collection, in bulk.
+    """
+
+    def __init__(self, experiment, db_name, db_uri=None,
+                 db_host="localhost", db_port=27017):
+        # imported here, in order to keep pymongo an optional dependency
+        from pymongo import MongoClient
+
+        if db_uri:
+            self.client = MongoClient(db_uri)
+        else:
+            self.client = MongoClient(db_host, db_port)
+
+        self.collection = self.client[db_name].events
+        self.experiment = experiment
+
+    def write(self, events):
+        # round-trip through json, in order to get only bson-compatible types
+        records = json.loads(json.dumps(events, default=_to_json))
+        for record in records:
+            record["experiment"] = self.experiment
+        self.collection.insert_many(records)
+
+    def close(self):
+        self.client.close()
+
+
+class AsyncLogger:
+    """
+    Queue the logging events and write them to the sinks in batches,
+    from a background thread, so that logging never blocks the training.
+
+    The events are dicts. Each sink has a write(events) method, which
+    receives the batch of the events that were queued since the last flush.
+    """
+
+    def __init__(self, sinks, flush_interval=1.0, max_batch=1000):
+        """
+
+        Args:
+            sinks (list): the sinks to write the events to
+            flush_interval (float): how often (seconds) to write the events
+            max_batch (int): the maximum number of events in a batch
+        """
+        self.sinks = sinks
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+
+        self._queue = Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def emit(self, event_type, key, **kwargs):
+        event = {"type": event_type, "key": key, "time": time.time()}
+        event.update(kwargs)
+        self._queue.put(event)
+
+    def _next_batch(self):
+        batch = []
+        deadline = time.time() + self.flush_interval
+
+        while len(batch) < self.max_batch:
+            try:
+                timeout = max(deadline - time.time(), 0)
+                batch.append(self._queue.get(timeout=timeout))
+            except Empty:
+                break
+
+        return batch
+
+    def _write(self, events):
+        for sink in self.sinks:
+            try:
+                sink.write(events)
+            except Exception as e:
+                print(f"Failed to write the logs to "
+                      f"{sink.__class__.__name__}: {e}")
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            stop = None in batch
+            events = [e for e in batch if e is not None]
+
+            if len(events) > 0:
+                self._write(events)
+
+            for _ in batch:
+                self._queue.task_done()
+
+            if stop:
+                return
+
+    def flush(self):
+        """
+        Block until all the queued events have been written.
+        """
+        if not self._closed:
+            self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+
+        self._queue.put(None)
+        self._thread.join()
+        self._closed = True
+
+        for sink in self.sinks:
+            sink.close()
+
+
+def default_sinks(name, output_dir, viz=None, use_db=False, **db_kwargs):
+    """
+    The sinks of an experiment: the local (append-only) logs, and optionally
+    Visdom and MongoDB. Locally, the history of the metrics is stored in
+    {name}.metrics (see MetricStore) and all the other events
+    in {name}.events.jsonl.
+    """
+    sinks = [MetricStoreSink(os.path.join(output_dir, f"{name}.metrics")),
+             JsonlSink(os.path.join(output_dir, f"{name}.events.jsonl"),
+                       types=["experiment", "value"])]
+
+    if viz is not None:
+        sinks.append(VisdomSink(viz))
+
+    if use_db:
+        try:
+            sinks.append(MongoSink(name, **db_kwargs))
+        except ImportError:
+            print("pymongo is not installed. Skipping the MongoDB logging...")
+
+    return sinks
@@ -1,3 +1,4 @@
+import atexit
 import json
 import os
 import pickle
@@ -6,9 +7,9 @@ import time
 from collections import defaultdict
 from datetime import datetime
 
-from pymongo import MongoClient
 from tabulate import tabulate
 
+from mylogger.backend import AsyncLogger, default_sinks
 from mylogger.helpers import dict_to_html, files_to_dict
 from mylogger.plotting import Visualizer
 from sys_config import VIS, BASE_DIR
@@ -26,11 +27,17 @@ class Experiment(object):
                  db_host="localhost",
                  db_port=27017,
                  db_uri=None,
-                 db_name="experiments"):
+                 db_name="experiments",
+                 flush_interval=1.0):
         """
 
         Metrics = history of values
         Values = state of values
+
+        All the updates are logged asynchronously (see AsyncLogger),
+        to append-only local files ({name}.metrics and {name}.events.jsonl)
+        and optionally to Visdom and MongoDB.
+
         Args:
             name:
             config:
@@ -42,6 +49,7 @@ class Experiment(object):
             db_port:
             db_uri: mongodb://[username:password@]host1[:port1]
             db_name:
+            flush_interval: how often (seconds) to write the queued logs
         """
         self.name = name
         self.desc = desc
@@ -81,6 +89,7 @@ class Experiment(object):
         self.enabled = VIS["enabled"]
         vis_log_file = os.path.join(self.output_dir, f"{self.name}.vis")
 
+        self.viz = None
         if self.enabled:
             self.viz = Visualizer(env=name,
                                   server=server,
@@ -90,20 +99,25 @@ class Experiment(object):
                                   http_proxy_port=http_proxy_port,
                                   log_to_filename=vis_log_file)
 
+        sinks = default_sinks(self.name, self.output_dir, self.viz,
+                              use_db=self.use_db and self.enabled,
+                              db_name=self.db_name, db_uri=self.db_uri,
+                              db_host=self.db_host, db_port=self.db_port)
+        self.logger = AsyncLogger(sinks, flush_interval=flush_interval)
+        atexit.register(self.close)
+
+        # log the static information of the experiment only once
+        self.logger.emit("experiment", self.name,
+                         desc=self.desc,
+                         config=self.config,
+                         src=self.src,
+                         src_main=self.src_main,
+                         timestamp=self.get_timestamp())
+
+        if self.enabled:
             self.add_value("config", "text")
             self.update_value("config", dict_to_html(self.config))
 
-        # connect to MongoDB
-        if self.use_db and self.enabled:
-            if self.db_uri:
-                self.db_client = MongoClient(self.db_uri)
-            else:
-                self.db_client = MongoClient(self.db_host, self.db_port)
-
-            self.db = self.db_client[self.db_name]
-            self.db_collection = self.db.experiments
-            self.db_record = None
-
     #############################################################
     # Metric
     #############################################################
@@ -146,20 +160,29 @@ class Experiment(object):
         Returns:
 
         """
-        self.get_metric(key).add(value, tag)
+        metric = self.get_metric(key)
+        metric.add(value, tag)
+
+        if metric.tags is not None:
+            step = len(metric.values[tag])
+        else:
+            step = len(metric.values)
 
+        plot = {}
         try:
             if self.enabled:
-                self.__plot_metric(key)
+                plot = self.__plot_metric(key)
 
         except IndexError as e:
             pass
 
-        except Exception as e:
-            print(f"An error occurred while trying to plot metric:{key}")
+        self.logger.emit("metric", key, tag=tag, step=step, value=value,
+                         **plot)
 
     def __plot_metric(self, key):
-
+        """
+        Returns: the arguments of the plot of the (last values of the) metric
+        """
         metric = self.get_metric(key)
 
         if metric.vis_type == "line":
@@ -170,7 +193,9 @@ class Experiment(object):
             else:
                 x = [len(metric.values)]
                 y = [metric.values[-1]]
-            self.viz.plot_line(y, x, metric.title, metric.tags)
+
+            return dict(plot="line", x=x, y=y, title=metric.title,
+                        legend=metric.tags)
 
         elif metric.vis_type == "scatter":
             raise NotImplementedError
@@ -201,66 +226,39 @@ class Experiment(object):
         """
         self.get_value(key).update(value, tag)
 
+        plot = {}
         try:
             if self.enabled:
-                self.__plot_value(key)
+                plot = self.__plot_value(key)
 
-        except IndexError as e:
-            pass
-
-        except Exception as e:
+        except NotImplementedError as e:
             print(f"An error occurred while trying to plot value:{key}")
 
+        self.logger.emit("value", key, tag=tag, value=value, **plot)
+
     def __plot_value(self, key):
+        """
+        Returns: the arguments of the plot of the value
+        """
         value = self.get_value(key)
 
-        if value.vis_type == "text":
-            self.viz.plot_text(value.value, value.title, pre=value.pre)
-        elif value.vis_type == "scatter":
-            if value.tags is not None:
-                raise NotImplementedError
-            else:
-                data = value.value
-
-            self.viz.plot_scatter(data[0], data[1], value.title)
-        elif value.vis_type == "heatmap":
-            if value.tags is not None:
-                raise NotImplementedError
-            else:
-                data = value.value
-
-            self.viz.plot_heatmap(data[0], data[1], value.title)
-        elif value.vis_type == "bar":
-            if value.tags is not None:
-                raise NotImplementedError
-            else:
-                data = value.value
+        if value.vis_type not in ["text", "scatter", "heatmap", "bar"]:
+            raise NotImplementedError
 
-            self.viz.plot_bar(data[0], data[1], value.title)
-        else:
+        if value.vis_type != "text" and value.tags is not None:
             raise NotImplementedError
 
+        return dict(plot=value.vis_type, title=value.title, pre=value.pre)
+
     #############################################################
     # Persistence
     #############################################################
     def _state_dict(self):
-        omit = ["db", "db_client", "db_collection"]
+        omit = ["viz", "logger"]
         state = {k: v for k, v in self.__dict__.items() if k not in omit}
 
         return state
 
-    def to_db(self):
-        self.timestamp_update = datetime.now()
-        # record = self._state_dict()
-
-        # todo: avoid this workaround
-        record = json.loads(self._serialize())
-
-        if self.db_record is None:
-            self.db_record = self.db_collection.insert(record)
-        else:
-            self.db_collection.replace_one({"_id": self.db_record}, record)
-
     def _serialize(self):
 
         data = json.dumps(self._state_dict(),
@@ -285,20 +283,15 @@ class Experiment(object):
             pickle.dump(self._state_dict(), f)
 
     def save(self):
-        try:
-            self.to_pickle()
-        except:
-            print("Failed to save to pickle...")
-
-        # try:
-        #     self.to_json()
-        # except:
-        #     print("Failed to save to json...")
-
-        # try:
-        #     self.to_db()
-        # except:
-        #     print("Failed to save to db...")
+        """
+        Write all the queued logs. The history of the experiment is
+        already in the (append-only) logs, so nothing is re-written.
+        """
+        self.timestamp_update = datetime.now()
+        self.logger.flush()
+
+    def close(self):
+        self.logger.close()
 
     def log_metrics(self, keys):
 
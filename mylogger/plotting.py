@@ -1,7 +1,6 @@
 import numpy
-from visdom import Visdom
-import matplotlib.pyplot as plt
-import seaborn as sns
+
+from mylogger.store import read_metrics
 
 
 class Visualizer:
@@ -13,6 +12,9 @@ class Visualizer:
                  http_proxy_host=None,
                  http_proxy_port=None,
                  log_to_filename=None):
+        # imported here, so that visdom is loaded only when it is enabled
+        from visdom import Visdom
+
         self._viz = Visdom(env=env,
                            server=server,
                            port=port,
@@ -84,3 +86,39 @@ class Visualizer:
                               }
                               }
                           ))
+
+
+def plot_metric_history(filename, key, tags=None, title=None, ax=None):
+    """
+    Plot the history of a metric of a run, from its MetricStore file
+    (e.g. experiments/{name}.metrics).
+
+    Args:
+        filename (str): the MetricStore file of the run
+        key (str): the name of the metric
+        tags (list): plot only the given tags of the metric
+        title (str): the title of the figure
+        ax: the matplotlib axes to plot to
+
+    Returns: the matplotlib axes
+
+    """
+    import matplotlib.pyplot as plt
+
+    series = read_metrics(filename)[key]
+
+    if ax is None:
+        fig, ax = plt.subplots()
+
+    for tag, columns in series.items():
+        if tags is not None and tag not in tags:
+            continue
+        ax.plot(columns["step"], columns["value"], label=tag)
+
+    if any(tag is not None for tag in series):
+        ax.legend()
+
+    ax.set_title(title or key)
+    ax.set_xlabel("step")
+
+    return ax
@@ -0,0 +1,164 @@
+import json
+import os
+import struct
+from collections import defaultdict
+
+import numpy
+
+# each block of the file is:
+# [header size (uint32)] [header (json)] [steps] [values] [times]
+# where the header contains the key, the tag and the number of points (n)
+# of a series, followed by its 3 columns, with n points each.
+_HEADER = struct.Struct("<I")
+_COLUMNS = [("step", numpy.int64), ("value", numpy.float64),
+            ("time", numpy.float64)]
+
+
+class MetricStore:
+    """
+    Append-only, columnar store of the history of the metrics of a run.
+
+    The points are buffered in memory and each flush appends only the new
+    points to the file (one block per series), so the cost of each flush
+    does not depend on the length of the history.
+    Use `compact` to merge the blocks of each series.
+
+    If the file ends with a partially written block (e.g., after a crash),
+    it is truncated to its last complete block, so that the new blocks
+    (e.g., of a resumed run) are appended after it.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._buffer = defaultdict(list)
+
+        _truncate_partial_block(filename)
+
+    def append(self, key, step, value, time, tag=None):
+        self._buffer[(key, tag)].append((step, value, time))
+
+    def flush(self):
+        if len(self._buffer) == 0:
+            return
+
+        with open(self.filename, "ab") as f:
+            for (key, tag), points in self._buffer.items():
+                _write_block(f, key, tag, list(zip(*points)))
+        self._buffer.clear()
+
+    def read(self):
+        """
+        Returns: the history of all the metrics (see read_metrics),
+            including the points that have not been flushed yet
+        """
+        self.flush()
+        return read_metrics(self.filename)
+
+    def compact(self):
+        self.flush()
+        compact_metrics(self.filename)
+
+
+def _write_block(f, key, tag, columns):
+    header = json.dumps({"key": key, "tag": tag,
+                         "n": len(columns[0])}).encode("utf-8")
+    f.write(_HEADER.pack(len(header)))
+    f.write(header)
+    for (_, dtype), column in zip(_COLUMNS, columns):
+        f.write(numpy.asarray(column, dtype=dtype).tobytes())
+
+
+def _parse_blocks(data):
+    """
+    Parse the complete blocks of the contents of a file.
+
+    Yields: the key, the tag, the columns and the end offset of each block
+    """
+    offset = 0
+    while offset + _HEADER.size <= len(data):
+        size, = _HEADER.unpack_from(data, offset)
+        start = offset + _HEADER.size
+        if start + size > len(data):
+            break
+        try:
+            header = json.loads(data[start:start + size].decode("utf-8"))
+        except ValueError:
+            break
+        offset = start + size
+
+        columns = []
+        for _, dtype in _COLUMNS:
+            nbytes = header["n"] * numpy.dtype(dtype).itemsize
+            columns.append(numpy.frombuffer(data, dtype, header["n"], offset)
+                           if offset + nbytes <= len(data) else None)
+            offset += nbytes
+
+        # stop at a partially written (last) block, e.g. after a crash
+        if any(c is None for c in columns):
+            break
+
+        yield header["key"], header["tag"], columns, offset
+
+
+def _read_blocks(filename):
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    for key, tag, columns, _ in _parse_blocks(data):
+        yield key, tag, columns
+
+
+def _truncate_partial_block(filename):
+    """
+    Truncate the file to the end of its last complete block.
+    """
+    if not os.path.exists(filename):
+        return
+
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    end = 0
+    for *_, end in _parse_blocks(data):
+        pass
+
+    if end < len(data):
+        with open(filename, "r+b") as f:
+            f.truncate(end)
+
+
+def read_metrics(filename):
+    """
+    Read the history of the metrics of a run.
+
+    Returns:
+        dict: {key: {tag: {"step": ndarray, "value": ndarray,
+            "time": ndarray}}}. The tag of the untagged metrics is None.
+    """
+    blocks = defaultdict(list)
+
+    if os.path.exists(filename):
+        for key, tag, columns in _read_blocks(filename):
+            blocks[(key, tag)].append(columns)
+
+    metrics = defaultdict(dict)
+    for (key, tag), columns in blocks.items():
+        metrics[key][tag] = {name: numpy.concatenate(c) for (name, _), c in
+                             zip(_COLUMNS, zip(*columns))}
+
+    return dict(metrics)
+
+
+def compact_metrics(filename):
+    """
+    Rewrite the file, with a single block for each series.
+    """
+    metrics = read_metrics(filename)
+
+    with open(filename + ".tmp", "wb") as f:
+        for key, tags in metrics.items():
+            for tag, columns in tags.items():
+                _write_block(f, key, tag, [columns[name]
+                                           for name, _ in _COLUMNS])
+
+    os.replace(filename + ".tmp", filename)
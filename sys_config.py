@@ -2,9 +2,11 @@ import os
 
 import torch
 
-print("torch:", torch.__version__)
-print("Cuda:", torch.backends.cudnn.cuda)
-print("CuDNN:", torch.backends.cudnn.version())
+
+def print_environment():
+    print("torch:", torch.__version__)
+    print("Cuda:", torch.backends.cudnn.cuda)
+    print("CuDNN:", torch.backends.cudnn.version())
 
 CPU_CORES = 4
 RANDOM_SEED = 1618
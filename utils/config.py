@@ -24,7 +24,10 @@ def make_paths(cfg):
     """
     for key in cfg.keys():
         if key.endswith("_path"):
-            if cfg[key] is not None:
+            if isinstance(cfg[key], list):
+                cfg[key] = [os.path.abspath(os.path.join(DATA_DIR, x))
+                            for x in cfg[key]]
+            elif cfg[key] is not None:
                 cfg[key] = os.path.join(DATA_DIR, cfg[key])
                 cfg[key] = os.path.abspath(cfg[key])
         if type(cfg[key]) is dict:
@@ -1,10 +1,9 @@
-import pandas
-
-import rouge
 from tabulate import tabulate
 
 
 def rouge_lists(refs, hyps):
+    import rouge
+
     evaluator = rouge.Rouge(metrics=['rouge-n', 'rouge-l'],
                             max_n=2,
                             limit_length=True,
@@ -36,6 +35,8 @@ def rouge_file_list(refs_file, hyps_list):
 
 
 def pprint_rouge_scores(scores, pivot=False):
+    import pandas
+
     pdt = pandas.DataFrame(scores)
 
     if pivot:
@@ -1,8 +1,6 @@
 from itertools import zip_longest
 
 import numpy
-import umap
-from sklearn.decomposition import PCA
 
 
 def merge_dicts(a, b):
@@ -49,6 +47,10 @@ def concat_multiline_strings(a, b):
 
 
 def dim_reduce(data_sets, n_components=2, method="PCA"):
+    # imported here, as they are slow to import and rarely used
+    import umap
+    from sklearn.decomposition import PCA
+
     data = numpy.vstack(data_sets)
     splits = numpy.cumsum([0] + [len(x) for x in data_sets])
     if method == "PCA":
@@ -1,39 +1,211 @@
 import errno
+import itertools
 import os
-import pickle
+from multiprocessing import Pool
 
 import numpy
+from numpy.lib.format import open_memmap
 
 
 def file_cache_name(file):
+    """
+    The prefix of the binary cache files of an embeddings file:
+        - {prefix}.vectors.npy: the (float32) embeddings matrix
+        - {prefix}.words.txt: the words, one per row of the matrix
+        - {prefix}.stats.npy: the mean and std of the embeddings
+    """
     head, tail = os.path.split(file)
     filename, ext = os.path.splitext(tail)
-    return os.path.join(head, filename + ".p")
+    return os.path.join(head, filename)
 
 
-def write_cache_word_vectors(file, data):
-    with open(file_cache_name(file), 'wb') as pickle_file:
-        pickle.dump(data, pickle_file)
+def _cache_files(file):
+    prefix = file_cache_name(file)
+    return (prefix + ".vectors.npy",
+            prefix + ".words.txt",
+            prefix + ".stats.npy")
 
 
-def load_cache_word_vectors(file):
-    with open(file_cache_name(file), 'rb') as f:
-        return pickle.load(f)
+def _byte_ranges(file, start, n):
+    """
+    Split the bytes of a file, after `start`, into `n` ranges,
+    aligned to line boundaries.
+    """
+    size = os.path.getsize(file)
+    bounds = {start, size}
+    with open(file, "rb") as f:
+        for i in range(1, n):
+            f.seek(max(start + (size - start) * i // n - 1, start))
+            f.readline()
+            bounds.add(min(f.tell(), size))
 
+    bounds = sorted(bounds)
+    return list(zip(bounds[:-1], bounds[1:]))
 
-def load_word_vectors(file, dim):
+
+def _read_blocks(file, start, end, block_size=2 ** 24):
     """
-    Read the word vectors from a text file
+    Read the (non-empty) lines in a byte range of a file, in blocks.
+    """
+    with open(file, "rb") as f:
+        f.seek(start)
+        while f.tell() < end:
+            data = f.read(min(block_size, end - f.tell()))
+            if f.tell() < end:
+                data += f.readline()
+            yield [line for line in data.splitlines() if line.strip()]
+
+
+def _count_lines(args):
+    """
+    Count the lines in a byte range of a file and check
+    whether it contains the unk token.
+    """
+    file, start, end = args
+    count, has_unk = 0, False
+    for lines in _read_blocks(file, start, end):
+        count += len(lines)
+        has_unk = has_unk or any(l.startswith(b"<unk> ") for l in lines)
+    return count, has_unk
+
+
+def _parse_lines(args):
+    """
+    Parse the word vectors in a byte range of a file and write them
+    to the rows of the (memory-mapped) embeddings matrix,
+    starting from row `offset`.
+    """
+    file, start, end, dim, vectors_file, offset = args
+
+    vectors = numpy.load(vectors_file, mmap_mode="r+")
+
+    words = []
+    total = numpy.zeros(dim, dtype=numpy.float64)
+    total_sq = numpy.zeros(dim, dtype=numpy.float64)
+
+    row = offset
+    for lines in _read_blocks(file, start, end):
+        parts = [line.partition(b" ") for line in lines]
+        values = numpy.fromstring(b" ".join(p[2] for p in parts),
+                                  dtype=numpy.float32, sep=" ")
+
+        if values.size != len(lines) * dim:
+            raise ValueError(f"Invalid word vectors in {file}. "
+                             f"Expected vectors with {dim} dimensions.")
+
+        values = values.reshape(-1, dim)
+        vectors[row:row + len(lines)] = values
+        row += len(lines)
+
+        words.extend(p[0].decode("utf-8") for p in parts)
+        total += values.sum(0, dtype=numpy.float64)
+        total_sq += numpy.square(values, dtype=numpy.float64).sum(0)
+
+    vectors.flush()
+
+    return words, total, total_sq
+
+
+def build_word_vectors_cache(file, dim, workers=None):
+    """
+    Parse a text file with word vectors (GloVe or word2vec format) and
+    write it to a binary cache, which can be memory-mapped.
+    The file is split into chunks, that are parsed in parallel and are
+    written directly to the cache.
+
     Args:
         file (): the filename
         dim (): the dimensions of the word vectors
+        workers (int): the number of processes. Defaults to the cpu count.
+
+    """
+    if not os.path.exists(file):
+        print("{} not found!".format(file))
+        raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), file)
+
+    print('Indexing file {} ...'.format(file))
+
+    vectors_file, words_file, stats_file = _cache_files(file)
+
+    # skip the first row if it is a header
+    with open(file, "rb") as f:
+        first = f.readline()
+        start = f.tell() if len(first.split()) < dim else 0
+
+    workers = workers or os.cpu_count()
+    ranges = _byte_ranges(file, start, workers * 4)
+
+    with Pool(workers) as pool:
+        counts = pool.map(_count_lines, [(file, s, e) for s, e in ranges])
+        has_unk = any(x[1] for x in counts)
+
+        # We reserve the first row (idx=0), as the word embedding,
+        # which will be used for zero padding (word with id = 0),
+        # and the last one for the unk token, if it is missing.
+        offsets = numpy.cumsum([1] + [x[0] for x in counts])
+        rows = int(offsets[-1]) + (0 if has_unk else 1)
+        vectors = open_memmap(vectors_file + ".tmp", mode="w+",
+                              dtype=numpy.float32, shape=(rows, dim))
+        vectors[0] = 0
+        vectors.flush()
+
+        jobs = [(file, s, e, dim, vectors_file + ".tmp", int(offset))
+                for (s, e), offset in zip(ranges, offsets)]
+        results = pool.map(_parse_lines, jobs)
+
+    words = [""]
+    total = numpy.zeros(dim, dtype=numpy.float64)
+    total_sq = numpy.zeros(dim, dtype=numpy.float64)
+    for _words, _total, _total_sq in results:
+        words.extend(_words)
+        total += _total
+        total_sq += _total_sq
+
+    # add an unk token, for OOV words
+    if not has_unk:
+        unk = numpy.random.uniform(low=-0.05, high=0.05, size=dim)
+        vectors[-1] = unk
+        words.append("<unk>")
+        total += unk
+        total_sq += numpy.square(unk)
+
+    mean = total / rows
+    std = numpy.sqrt(numpy.maximum(total_sq / rows - numpy.square(mean), 0))
+
+    print('Found %s word vectors.' % rows)
+
+    vectors.flush()
+    del vectors
+    os.replace(vectors_file + ".tmp", vectors_file)
+
+    with open(words_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(words))
+
+    numpy.save(stats_file, numpy.stack([mean, std]).astype(numpy.float32))
+
+
+def load_cache_word_vectors(file):
+    """
+    Load the binary cache of an embeddings file.
 
     Returns:
-        word2idx (dict): dictionary of words to ids
-        idx2word (dict): dictionary of ids to words
-        embeddings (numpy.ndarray): the word embeddings matrix
+        words (list): the words, one per row of the embeddings matrix
+        vectors (numpy.memmap): the (read-only) embeddings matrix
+        stats (numpy.ndarray): the mean (1st row) and
+            std (2nd row) of the embeddings
 
     """
+    vectors_file, words_file, stats_file = _cache_files(file)
+
+    vectors = numpy.load(vectors_file, mmap_mode="r")
+    stats = numpy.load(stats_file)
+    with open(words_file, "rb") as f:
+        words = [w.decode("utf-8") for w in f.read().split(b"\n")]
+
+    return words, vectors, stats
+
+
+def _load_or_build(file, dim):
     # in order to avoid this time consuming operation, cache the results
     try:
         cache = load_cache_word_vectors(file)
@@ -42,61 +214,167 @@ def load_word_vectors(file, dim):
     except OSError:
         print("Didn't find embeddings cache file {}".format(file))
 
-    # create the necessary dictionaries and the word embeddings matrix
-    if os.path.exists(file):
-        print('Indexing file {} ...'.format(file))
+    build_word_vectors_cache(file, dim)
+    return load_cache_word_vectors(file)
 
-        word2idx = {}  # dictionary of words to ids
-        idx2word = {}  # dictionary of ids to words
-        embeddings = []  # the word embeddings matrix
 
-        # create the 2D array, which will be used for initializing
-        # the Embedding layer of a NN.
-        # We reserve the first row (idx=0), as the word embedding,
-        # which will be used for zero padding (word with id = 0).
-        embeddings.append(numpy.zeros(dim))
+def load_word_vectors(file, dim):
+    """
+    Read the word vectors from a text file
+    Args:
+        file (): the filename
+        dim (): the dimensions of the word vectors
+
+    Returns:
+        word2idx (dict): dictionary of words to ids
+        idx2word (dict): dictionary of ids to words
+        embeddings (numpy.ndarray): the (memory-mapped) embeddings matrix
+
+    """
+    words, embeddings, _ = _load_or_build(file, dim)
+
+    word2idx = {w: i for i, w in enumerate(words) if i > 0}
+    idx2word = {i: w for w, i in word2idx.items()}
+
+    return word2idx, idx2word, embeddings
+
 
-        # flag indicating whether the first row of the embeddings file
-        # has a header
-        header = False
+def load_filtered_word_vectors(file, dim, tokens):
+    """
+    Read only the word vectors of the given tokens, from the binary cache
+    of a word vectors file (which is built, if it is missing).
+
+    Args:
+        file (): the filename
+        dim (): the dimensions of the word vectors
+        tokens (list): the tokens
 
-        # read file, line by line
-        with open(file, "r", encoding="utf-8") as f:
-            for i, line in enumerate(f, 1):
+    Returns:
+        embeddings (numpy.ndarray): the embeddings of the tokens.
+            The rows of the missing tokens are zeros.
+        found (numpy.ndarray): boolean mask of the tokens that were found
+        stats (numpy.ndarray): the mean (1st row) and
+            std (2nd row) of all the pretrained embeddings
 
-                # skip the first row if it is a header
-                if i == 1:
-                    if len(line.split()) < dim:
-                        header = True
-                        continue
+    """
+    words, vectors, stats = _load_or_build(file, dim)
 
-                values = line.split(" ")
-                word = values[0]
-                vector = numpy.asarray(values[1:], dtype='float32')
+    wanted = {t: i for i, t in enumerate(tokens)}
+    rows = {}
+    for row, word in enumerate(words):
+        if row > 0 and word in wanted:
+            rows[wanted[word]] = row
 
-                index = i - 1 if header else i
+    ids = numpy.fromiter(rows.keys(), dtype=numpy.int64, count=len(rows))
+    rows = numpy.fromiter(rows.values(), dtype=numpy.int64, count=len(rows))
+    order = numpy.argsort(rows)
 
-                idx2word[index] = word
-                word2idx[word] = index
-                embeddings.append(vector)
+    embeddings = numpy.zeros((len(tokens), vectors.shape[1]),
+                             dtype=numpy.float32)
+    embeddings[ids[order]] = vectors[rows[order]]
 
-            # add an unk token, for OOV words
-            if "<unk>" not in word2idx:
-                idx2word[len(idx2word) + 1] = "<unk>"
-                word2idx["<unk>"] = len(word2idx) + 1
-                embeddings.append(
-                    numpy.random.uniform(low=-0.05, high=0.05, size=dim))
+    found = numpy.zeros(len(tokens), dtype=bool)
+    found[ids] = True
 
-            print(set([len(x) for x in embeddings]))
+    return embeddings, found, stats
 
-            print('Found %s word vectors.' % len(embeddings))
-            embeddings = numpy.array(embeddings, dtype='float32')
 
-        # write the data to a cache file
-        write_cache_word_vectors(file, (word2idx, idx2word, embeddings))
+def _fasttext_ngrams(word, min_n, max_n):
+    """
+    The character n-grams of a word, as in fastText.
+    """
+    word = "<" + word + ">"
+    return [word[i:i + n]
+            for i in range(len(word))
+            for n in range(min_n, min(max_n, len(word) - i) + 1)
+            if not (n == 1 and (i == 0 or i + n == len(word)))]
 
-        return word2idx, idx2word, embeddings
 
+def fasttext_ngram_hashes(ngrams, buckets, compatible_hash=True):
+    """
+    Compute (in batch) the bucket of each n-gram, using the FNV-1a hash
+    of fastText. The hash of fastText operates on the UTF-8 bytes of each
+    n-gram, which are cast to (signed) int8 first. If not
+    `compatible_hash`, the (broken) hash of older gensim versions
+    is used, which operates on the unicode code points of each n-gram.
+
+    Args:
+        ngrams (list): list of n-grams (str)
+        buckets (int): the number of buckets
+        compatible_hash (bool): use the hash of fastText
+
+    Returns:
+        numpy.ndarray: the bucket of each n-gram
+
+    """
+    if compatible_hash:
+        codes = [numpy.frombuffer(n.encode("utf-8"), dtype=numpy.int8)
+                 for n in ngrams]
     else:
-        print("{} not found!".format(file))
-        raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), file)
+        codes = [numpy.frombuffer(n.encode("utf-32-le"), dtype=numpy.uint32)
+                 for n in ngrams]
+
+    lengths = numpy.array([len(c) for c in codes], dtype=numpy.int64)
+    matrix = numpy.zeros((len(codes), lengths.max(initial=0)),
+                         dtype=numpy.uint32)
+    for i, c in enumerate(codes):
+        matrix[i, :len(c)] = c.astype(numpy.uint32)
+
+    h = numpy.full(len(codes), 2166136261, dtype=numpy.uint32)
+    prime = numpy.uint32(16777619)
+    for k in range(matrix.shape[1]):
+        active = lengths > k
+        h[active] = (h[active] ^ matrix[active, k]) * prime
+
+    return h.astype(numpy.int64) % buckets
+
+
+def fasttext_vectors(wv, tokens):
+    """
+    Obtain the fastText vectors of the given tokens.
+    The vectors of the tokens in the vocabulary of the model are gathered
+    in bulk and the vectors of the rest are computed in batch,
+    as the average of the vectors of their character n-grams.
+
+    Args:
+        wv (FastTextKeyedVectors): the (gensim) fastText vectors
+        tokens (list): the tokens
+
+    Returns:
+        embeddings (numpy.ndarray): the embeddings of the tokens.
+            The rows of the tokens without any known n-gram are zeros.
+        found (numpy.ndarray): boolean mask of the tokens that
+            are in the vocabulary of the model
+
+    """
+    embeddings = numpy.zeros((len(tokens), wv.vector_size),
+                             dtype=numpy.float32)
+
+    rows = numpy.array([wv.vocab[t].index if t in wv.vocab else -1
+                        for t in tokens], dtype=numpy.int64)
+    found = rows >= 0
+    embeddings[found] = wv.vectors[rows[found]]
+
+    oov = numpy.flatnonzero(~found)
+    ngrams = [_fasttext_ngrams(tokens[i], wv.min_n, wv.max_n) for i in oov]
+    owners = numpy.repeat(oov, [len(n) for n in ngrams])
+    ngrams = list(itertools.chain.from_iterable(ngrams))
+
+    if len(ngrams) == 0:
+        return embeddings, found
+
+    hashes = fasttext_ngram_hashes(ngrams, wv.bucket,
+                                   getattr(wv, "compatible_hash", True))
+
+    # older gensim versions keep only the buckets of the seen n-grams
+    hash2index = getattr(wv, "hash2index", None)
+    if hash2index:
+        hashes = numpy.array([hash2index.get(h, -1) for h in hashes],
+                             dtype=numpy.int64)
+        owners, hashes = owners[hashes >= 0], hashes[hashes >= 0]
+
+    numpy.add.at(embeddings, owners, wv.vectors_ngrams[hashes])
+    counts = numpy.bincount(owners, minlength=len(tokens))
+    embeddings[oov] /= numpy.maximum(counts[oov], 1)[:, None]
+
+    return embeddings, found
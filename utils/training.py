@@ -1,8 +1,11 @@
 import datetime
+import json
 import os
 
+import numpy
 import torch
 
+from modules.data.vocab import Vocab
 from sys_config import BASE_DIR
 
 
@@ -72,3 +75,103 @@ def load_checkpoint(name, path=None, device=None):
     print("done!")
 
     return state
+
+
+def inference_checkpoint_dir(name, path=None):
+    if path is None:
+        path = os.path.join(BASE_DIR, "checkpoints")
+
+    return os.path.join(path, "{}.infer".format(name))
+
+
+def save_inference_checkpoint(weights, config, vocab, name, path=None,
+                              verbose=False):
+    """
+    Export a slim checkpoint, which contains only what is needed for
+    inference. The weights are written as raw (aligned) arrays in a single
+    file, so that they can be memory-mapped when loading, and the vocab
+    is stored as a plain list of tokens.
+    Tensors that share the same storage (tied weights) are written once.
+
+    Args:
+        weights (dict): the (subset of the) state_dict of the model
+        config (dict): the config of the model
+        vocab (Vocab): the vocabulary
+        name (str): the name of the exported checkpoint
+        path (str): the directory, in which to save the checkpoint
+
+    Returns:
+
+    """
+    directory = inference_checkpoint_dir(name, path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    if verbose:
+        print("exporting inference checkpoint:{} ...".format(directory))
+
+    tensors = {}
+    written = {}
+    offset = 0
+    with open(os.path.join(directory, "weights.bin"), "wb") as f:
+        for key, tensor in weights.items():
+            storage = (tensor.data_ptr(), tuple(tensor.size()), tensor.dtype)
+
+            if storage not in written:
+                array = numpy.ascontiguousarray(tensor.detach().cpu().numpy())
+
+                # align each array to 64 bytes
+                padding = -offset % 64
+                f.write(b"\0" * padding)
+                offset += padding
+
+                written[storage] = {"dtype": array.dtype.str,
+                                    "shape": list(array.shape),
+                                    "offset": offset}
+                f.write(array.tobytes())
+                offset += array.nbytes
+
+            tensors[key] = written[storage]
+
+    meta = {"config": config, "vocab": vocab.to_dict(), "tensors": tensors}
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump(meta, f, default=str)
+
+    return directory
+
+
+def load_inference_checkpoint(name, path=None):
+    """
+    Load a checkpoint, exported with `save_inference_checkpoint`.
+    The weights are memory-mapped (copy-on-write), so only the pages that
+    are actually read are loaded in memory.
+
+    Returns:
+        state (dict): with the same "config", "model" and "vocab" keys
+            as the full checkpoints
+
+    """
+    directory = inference_checkpoint_dir(name, path)
+
+    print("Loading inference checkpoint `{}` ...".format(directory), end=" ")
+
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+
+    buffer = numpy.memmap(os.path.join(directory, "weights.bin"),
+                          dtype=numpy.uint8, mode="c")
+
+    weights = {}
+    for key, t in meta["tensors"].items():
+        dtype = numpy.dtype(t["dtype"])
+        count = int(numpy.prod(t["shape"]))
+        array = numpy.frombuffer(buffer, dtype=dtype, count=count,
+                                 offset=t["offset"]).reshape(t["shape"])
+        weights[key] = torch.from_numpy(array)
+
+    vocab = Vocab()
+    vocab.from_dict(meta["vocab"])
+
+    print("done!")
+
+    return {"config": meta["config"], "model": weights, "vocab": vocab}